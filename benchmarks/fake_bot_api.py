@@ -0,0 +1,81 @@
+"""বেঞ্চমার্কের জন্য লোকাল ফেক Telegram Bot API সার্ভার।
+
+প্রতিটি কল মেথড অনুযায়ী রেকর্ড করে, কৃত্রিম লেটেন্সি যোগ করে এবং নির্দিষ্ট হারে 429 (RetryAfter) ফেরত দেয়।
+main.py কে TELEGRAM_API_URL=http://127.0.0.1:<port>/bot দিয়ে এর দিকে পাঠানো হয়।
+"""
+import asyncio
+import itertools
+import json
+import random
+import time
+from collections import Counter
+
+from aiohttp import web
+
+BOT_USER = {'id': 100000, 'is_bot': True, 'first_name': 'Bench', 'username': 'bench_bot'}
+
+
+class FakeBotAPI:
+    def __init__(self, latency=0.0, jitter=0.0, error_429_rate=0.0, retry_after=1, seed=0):
+        self.latency, self.jitter = latency, jitter
+        self.error_429_rate, self.retry_after = error_429_rate, retry_after
+        self.calls = Counter()
+        self.throttled = Counter()
+        self.chats = Counter()
+        self._random = random.Random(seed)
+        self._message_ids = itertools.count(1)
+        self._runner = None
+        self.url = None
+
+    def reset(self):
+        self.calls.clear()
+        self.throttled.clear()
+        self.chats.clear()
+
+    def _message(self, chat_id, **extra):
+        chat_id = int(chat_id or 0)
+        return {
+            'message_id': next(self._message_ids), 'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private' if chat_id > 0 else 'channel'}, **extra,
+        }
+
+    def _result(self, method, params):
+        chat_id = params.get('chat_id')
+        if method == 'getMe': return BOT_USER
+        if method == 'getUpdates': return []
+        if method == 'sendMediaGroup':
+            return [self._message(chat_id) for _ in json.loads(params.get('media', '[]'))]
+        if method in ('sendMessage', 'editMessageText'): return self._message(chat_id, text=params.get('text', ''))
+        if method == 'copyMessage': return {'message_id': next(self._message_ids)}
+        if method.startswith('send') or method.startswith('edit'): return self._message(chat_id)
+        return True
+
+    async def handle(self, request):
+        method = request.match_info['method']
+        params = dict(await request.post())
+        self.calls[method] += 1
+        if params.get('chat_id'): self.chats[params['chat_id']] += 1
+        delay = self.latency + (self._random.uniform(0, self.jitter) if self.jitter else 0)
+        if delay: await asyncio.sleep(delay)
+        if self.error_429_rate and method != 'getMe' and self._random.random() < self.error_429_rate:
+            self.throttled[method] += 1
+            return web.json_response({
+                'ok': False, 'error_code': 429,
+                'description': f'Too Many Requests: retry after {self.retry_after}',
+                'parameters': {'retry_after': self.retry_after},
+            }, status=429)
+        return web.json_response({'ok': True, 'result': self._result(method, params)})
+
+    async def start(self, host='127.0.0.1', port=0):
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_route('*', '/bot{token}/{method}', self.handle)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.url = f'http://{host}:{port}'
+        return self.url
+
+    async def stop(self):
+        if self._runner is not None: await self._runner.cleanup()
@@ -0,0 +1,338 @@
+"""main.py এর থ্রুপুট/লেটেন্সি বেঞ্চমার্ক - লোকাল ফেক Bot API ও লোকাল Postgres এর বিরুদ্ধে।
+
+আসল হ্যান্ডলার, শিডিউলার, বাফার ও ডেটাবেস কোড চলে; শুধু Telegram এর জায়গায় benchmarks/fake_bot_api.py থাকে।
+ডিফল্টভাবে সেন্ড রেট লিমিট অনেক বড় রাখা হয় যাতে বটের নিজের খরচ মাপা যায়
+(--telegram-limits দিলে main.py এর আসল লিমিট থাকে)।
+
+    BENCH_DATABASE_URL=postgresql://localhost/bot_bench python benchmarks/run.py
+    python benchmarks/run.py start_storm webapp_hits --json result.json
+    python benchmarks/run.py --baseline result.json      # রিগ্রেশন হলে exit code 1 (একই প্যারামিটারে চালাতে হবে)
+
+সতর্কতা: BENCH_DATABASE_URL এ বেঞ্চমার্কের ইউজার/লিঙ্ক/হিট লেখা হয় এবং broadcast সিনারিও সেখানকার
+সব সক্রিয় ইউজারকে (ফেক API তে) পাঠায় - শুধু আলাদা টেস্ট ডেটাবেস ব্যবহার করুন।
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from pathlib import Path
+
+import aiohttp
+import psycopg2.extensions
+from aiohttp.test_utils import TestServer
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from benchmarks.fake_bot_api import FakeBotAPI  # noqa: E402
+
+BENCH_TOKEN = "123456:BENCH"
+BENCH_ADMIN_ID = 1
+# বেঞ্চমার্ক ইউজারদের আইডি এই সংখ্যার পর থেকে, যাতে আসল আইডির সাথে না মেলে
+USER_ID_BASE = 9_000_000_000
+STORM_CODE = "bench_storm"
+
+main = None
+
+
+# --- ডেটাবেস রাউন্ড ট্রিপ গণনা ---
+class _StatementCount:
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self):
+        with self._lock: self.value += 1
+
+statements = _StatementCount()
+
+class _CountingCursorMixin:
+    def execute(self, query, vars=None):
+        statements.inc()
+        return super().execute(query, vars)
+
+    def executemany(self, query, vars_list):
+        statements.inc()
+        return super().executemany(query, vars_list)
+
+_counting_cursors = {}
+
+class CountingConnection(psycopg2.extensions.connection):
+    """যে cursor_factory ই চাওয়া হোক, প্রতিটি execute গণনা করে"""
+
+    def cursor(self, *args, **kwargs):
+        factory = kwargs.get('cursor_factory') or self.cursor_factory or psycopg2.extensions.cursor
+        if factory not in _counting_cursors:
+            _counting_cursors[factory] = type(f"Counting{factory.__name__}", (_CountingCursorMixin, factory), {})
+        kwargs['cursor_factory'] = _counting_cursors[factory]
+        return super().cursor(*args, **kwargs)
+
+
+# --- পরিমাপ ---
+def percentile(values, pct):
+    if not values: return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))]
+
+async def run_ops(op, count, concurrency):
+    """op(i) কে count বার, সর্বোচ্চ concurrency টি একসাথে চালায়; (লেটেন্সি তালিকা, মোট সময়) ফেরত দেয়"""
+    latencies = []
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one(i):
+        async with semaphore:
+            started = time.perf_counter()
+            await op(i)
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(count)))
+    return latencies, time.perf_counter() - started
+
+class Measurement:
+    """সিনারিওর সময়কালে DB স্টেটমেন্ট ও Bot API কলের পার্থক্য মাপে"""
+
+    def __init__(self, api):
+        self.api = api
+
+    def __enter__(self):
+        self.statements = statements.value
+        self.api.reset()
+        return self
+
+    def __exit__(self, *exc):
+        self.db_statements = statements.value - self.statements
+        self.api_calls = sum(self.api.calls.values())
+        self.throttled = sum(self.api.throttled.values())
+
+def report(name, ops, seconds, latencies, measurement):
+    return {
+        'scenario': name,
+        'ops': ops,
+        'seconds': round(seconds, 3),
+        'throughput': round(ops / seconds, 1) if seconds else 0.0,
+        'p50_ms': round(percentile(latencies, 50) * 1000, 2),
+        'p99_ms': round(percentile(latencies, 99) * 1000, 2),
+        'db_per_op': round(measurement.db_statements / ops, 3) if ops else 0.0,
+        'api_per_op': round(measurement.api_calls / ops, 3) if ops else 0.0,
+        'throttled': measurement.throttled,
+    }
+
+def command_update(application, update_id, user_id, text):
+    from telegram import Update
+    command = text.split()[0]
+    return Update.de_json({
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id, 'date': int(time.time()),
+            'chat': {'id': user_id, 'type': 'private'},
+            'from': {'id': user_id, 'is_bot': False, 'first_name': 'Bench'},
+            'text': text, 'entities': [{'type': 'bot_command', 'offset': 0, 'length': len(command)}],
+        },
+    }, application.bot)
+
+def execute(sql, params=None):
+    conn = main.get_db_connection()
+    try:
+        with conn.cursor() as cur:
+            cur.execute(sql, params)
+            conn.commit()
+            return cur.fetchone() if cur.description else None
+    finally: main.release_db_connection(conn)
+
+def seed_users(count):
+    execute(
+        "INSERT INTO users (user_id, username, full_name, is_active) "
+        "SELECT id, 'bench_' || id, 'Bench User', TRUE FROM generate_series(%s, %s) AS id "
+        "ON CONFLICT (user_id) DO UPDATE SET is_active = TRUE",
+        (USER_ID_BASE + 1, USER_ID_BASE + count)
+    )
+
+
+# --- সিনারিও ---
+async def start_storm(application, api, args):
+    """একই কোডে একসাথে অনেক /start <code> (ডিপ-লিঙ্ক স্টর্ম)"""
+    await main.run_db(execute, "DELETE FROM files WHERE custom_code = %s", (STORM_CODE,))
+    items = [{'type': 'text', 'id': 'hello'}] + [{'type': 'photo', 'id': f'photo-{i}'} for i in range(3)] + [{'type': 'document', 'id': 'doc-0'}]
+    await main.run_db(main.insert_file_bundle, STORM_CODE, 'Bench bundle', items)
+
+    async def op(i):
+        await application.process_update(command_update(application, i, USER_ID_BASE + i + 1, f"/start {STORM_CODE}"))
+
+    with Measurement(api) as m:
+        latencies, seconds = await run_ops(op, args.requests, args.concurrency)
+        await main.run_db(main.user_buffer.flush)
+    return report('start_storm', args.requests, seconds, latencies, m)
+
+async def webapp_hits(application, api, args):
+    """/webapp-open এ মিনি অ্যাপ হিটের ঝড় (একই ইউজার বারবার সহ)"""
+    server = TestServer(main.build_web_app(application))
+    await server.start_server()
+    users = max(1, args.requests // 4)
+    try:
+        async with aiohttp.ClientSession() as session:
+            async def op(i):
+                async with session.get(server.make_url(f"/webapp-open/{USER_ID_BASE + i % users + 1}")) as resp:
+                    await resp.read()
+
+            with Measurement(api) as m:
+                latencies, seconds = await run_ops(op, args.requests, args.concurrency)
+                await main.run_db(main.hit_buffer.flush)
+    finally: await server.close()
+    return report('webapp_hits', args.requests, seconds, latencies, m)
+
+async def broadcast(application, api, args):
+    """args.broadcast_users জন সক্রিয় ইউজারকে ব্রডকাস্ট"""
+    await main.run_db(seed_users, args.broadcast_users)
+    total = await main.run_db(main.count_active_users)
+    latencies = []
+    copy = main._broadcast_copy
+
+    async def timed_copy(bot, job, user_id):
+        started = time.perf_counter()
+        try: return await copy(bot, job, user_id)
+        finally: latencies.append(time.perf_counter() - started)
+
+    main._broadcast_copy = timed_copy
+    try:
+        with Measurement(api) as m:
+            job = await main.run_db(main.create_broadcast_job, BENCH_ADMIN_ID, 1, total, BENCH_ADMIN_ID, 1)
+            started = time.perf_counter()
+            await main.run_broadcast_job(application.bot, job)
+            seconds = time.perf_counter() - started
+    finally: main._broadcast_copy = copy
+    return report('broadcast', total, seconds, latencies, m)
+
+async def statics(application, api, args):
+    """বড় users/app_hits টেবিলের উপর /statics 90"""
+    await main.run_db(seed_users, args.broadcast_users)
+    existing = (await main.run_db(execute, "SELECT COUNT(*) FROM app_hits"))[0]
+    if existing < args.statics_hits:
+        # শুধু চলতি মাসের সময়ে লেখা হয়, যাতে পার্টিশন সবসময় থাকে
+        await main.run_db(execute, """
+            INSERT INTO app_hits (user_id, hit_time)
+            SELECT %s + (g %% %s) + 1,
+                   date_trunc('month', now()) + (now() - date_trunc('month', now())) * random()
+            FROM generate_series(1, %s) AS g
+        """, (USER_ID_BASE, max(1, args.broadcast_users), args.statics_hits - existing))
+
+    async def op(i):
+        await application.process_update(command_update(application, i, BENCH_ADMIN_ID, "/statics 90"))
+
+    with Measurement(api) as m:
+        latencies, seconds = await run_ops(op, args.statics_requests, args.concurrency)
+    return report('statics', args.statics_requests, seconds, latencies, m)
+
+SCENARIOS = {'start_storm': start_storm, 'webapp_hits': webapp_hits, 'broadcast': broadcast, 'statics': statics}
+
+
+# --- রিপোর্ট ও বেসলাইন ---
+COLUMNS = ('scenario', 'ops', 'seconds', 'throughput', 'p50_ms', 'p99_ms', 'db_per_op', 'api_per_op', 'throttled')
+
+def print_table(results):
+    rows = [COLUMNS] + [tuple(str(r[c]) for c in COLUMNS) for r in results]
+    widths = [max(len(row[i]) for row in rows) for i in range(len(COLUMNS))]
+    for row in rows:
+        print("  ".join(cell.ljust(width) for cell, width in zip(row, widths)))
+
+def compare(results, baseline, tolerance):
+    """বেসলাইনের চেয়ে tolerance এর বেশি খারাপ হলে সমস্যাগুলোর তালিকা দেয়"""
+    base = {r['scenario']: r for r in baseline}
+    problems = []
+    for r in results:
+        b = base.get(r['scenario'])
+        if not b: continue
+        if r['throughput'] < b['throughput'] * (1 - tolerance):
+            problems.append(f"{r['scenario']}: throughput {r['throughput']} < baseline {b['throughput']}")
+        if r['p99_ms'] > b['p99_ms'] * (1 + tolerance):
+            problems.append(f"{r['scenario']}: p99 {r['p99_ms']}ms > baseline {b['p99_ms']}ms")
+        if r['db_per_op'] > b['db_per_op'] * (1 + tolerance) + 0.01:
+            problems.append(f"{r['scenario']}: db_per_op {r['db_per_op']} > baseline {b['db_per_op']}")
+    return problems
+
+
+async def run(args):
+    global main
+    api = FakeBotAPI(args.api_latency / 1000, args.api_jitter / 1000, args.rate_429, args.retry_after)
+    api_url = await api.start()
+    # main.py ইম্পোর্টের সময় কনফিগারেশন পড়ে, তাই আগে এনভায়রনমেন্ট সেট করা
+    os.environ.update({
+        'DATABASE_URL': args.database_url,
+        'BOT_TOKEN': BENCH_TOKEN,
+        'ADMIN_USER_ID': str(BENCH_ADMIN_ID),
+        'TELEGRAM_API_URL': f"{api_url}/bot",
+        'TELEGRAM_FILE_URL': f"{api_url}/file/bot",
+    })
+    os.environ.setdefault('DB_SSLMODE', 'disable')
+    if not args.telegram_limits:
+        os.environ.update({
+            'SEND_GLOBAL_RATE': '100000', 'SEND_GLOBAL_BURST': '100000', 'SEND_CHAT_RATE': '100000', 'SEND_CHAT_BURST': '100000',
+        })
+    import main as bot_main
+    main = bot_main
+    for name in ('main', 'httpx', 'telegram', 'aiohttp.access'): logging.getLogger(name).setLevel(logging.WARNING)
+
+    url = args.database_url.replace("postgres://", "postgresql://", 1)
+    main.db_pool = main.DBPool(url, main.DB_POOL_MIN, main.DB_POOL_MAX, main.DB_POOL_TIMEOUT, connection_factory=CountingConnection)
+    application = main.build_application()
+    # main.main() এর মতো: আগে মাইগ্রেশন, তারপর ফ্লাশ থ্রেড
+    await main.run_db(main.migrate_db)
+    main.user_buffer.start()
+    main.hit_buffer.start()
+    main.bot_persistence.buffer.start()
+    results = []
+    try:
+        await application.initialize()
+        await main.post_init(application)
+        await application.start()
+        for name in args.scenarios:
+            results.append(await SCENARIOS[name](application, api, args))
+            print(f"{name}: done", file=sys.stderr)
+    finally:
+        if application.running: await application.stop()
+        await main.post_stop(application)
+        await application.shutdown()
+        main.user_buffer.stop()
+        main.hit_buffer.stop()
+        main.bot_persistence.buffer.stop()
+        main.db_executor.shutdown(wait=True)
+        main.db_pool.closeall()
+        await api.stop()
+    return results
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="Benchmark main.py against a fake Bot API and a local Postgres")
+    parser.add_argument('scenarios', nargs='*', help=f"any of {', '.join(SCENARIOS)} (default: all)")
+    parser.add_argument('--database-url', default=os.getenv("BENCH_DATABASE_URL"), help="dedicated Postgres (BENCH_DATABASE_URL)")
+    parser.add_argument('--requests', type=int, default=2000, help="updates/hits for start_storm and webapp_hits")
+    parser.add_argument('--concurrency', type=int, default=64)
+    parser.add_argument('--broadcast-users', type=int, default=100_000)
+    parser.add_argument('--statics-requests', type=int, default=200)
+    parser.add_argument('--statics-hits', type=int, default=1_000_000, help="app_hits rows to seed for statics")
+    parser.add_argument('--api-latency', type=float, default=20, help="fake Bot API latency in ms")
+    parser.add_argument('--api-jitter', type=float, default=10, help="extra random latency in ms")
+    parser.add_argument('--rate-429', type=float, default=0.0, help="fraction of Bot API calls answered with 429")
+    parser.add_argument('--retry-after', type=int, default=1)
+    parser.add_argument('--telegram-limits', action='store_true', help="keep main.py's real send rate limits")
+    parser.add_argument('--json', help="write results to this file")
+    parser.add_argument('--baseline', help="compare with a previous --json result")
+    parser.add_argument('--tolerance', type=float, default=0.2, help="allowed regression vs baseline (0.2 = 20%%)")
+    args = parser.parse_args()
+    if not args.database_url: parser.error("BENCH_DATABASE_URL or --database-url is required")
+    unknown = [name for name in args.scenarios if name not in SCENARIOS]
+    if unknown: parser.error(f"unknown scenario(s): {', '.join(unknown)}")
+    args.scenarios = args.scenarios or list(SCENARIOS)
+
+    results = asyncio.run(run(args))
+    print_table(results)
+    if args.json:
+        Path(args.json).write_text(json.dumps(results, indent=2))
+    if args.baseline:
+        problems = compare(results, json.loads(Path(args.baseline).read_text()), args.tolerance)
+        for problem in problems: print(f"REGRESSION {problem}", file=sys.stderr)
+        if problems: sys.exit(1)
+
+if __name__ == '__main__':
+    main_cli()
@@ -1,13 +1,32 @@
 import logging
 import os
+import re
+import sys
+import json
 import threading
 import asyncio
+import time
+import signal
+import socket
+import functools
+import itertools
+import hmac
+from collections import Counter, OrderedDict
 import psycopg2
-from flask import Flask, request
+import psycopg2.extras
+import psycopg2.errors
+from psycopg2 import pool as pg_pool
+from aiohttp import web
+from prometheus_client import Counter as MetricCounter, Gauge, Histogram, generate_latest, CONTENT_TYPE_LATEST
 from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
 
 # v20+ অনুযায়ী ইম্পোর্ট স্টেটমেন্ট
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, BotCommand, BotCommandScopeChat, WebAppInfo
+from telegram import (
+    Update, InlineKeyboardButton, InlineKeyboardMarkup, BotCommand, BotCommandScopeChat, WebAppInfo,
+    InputMediaPhoto, InputMediaVideo, InputMediaDocument, InputMediaAudio,
+)
+from telegram.error import RetryAfter, Forbidden, BadRequest
 from telegram.ext import (
     Application,
     CommandHandler,
@@ -16,6 +35,9 @@ from telegram.ext import (
     ContextTypes,
     ConversationHandler,
     CallbackQueryHandler,
+    TypeHandler,
+    BasePersistence,
+    PersistenceInput,
 )
 
 # লগিং সিস্টেম সেটআপ
@@ -26,127 +48,1004 @@ logger = logging.getLogger(__name__)
 DATABASE_URL = os.getenv("DATABASE_URL")
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 ADMIN_USER_ID = int(os.getenv("ADMIN_USER_ID", 0))
+# লোকাল ফেক Bot API (benchmarks/) বা নিজস্ব Bot API সার্ভারের জন্য বদলানো যায়
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "https://api.telegram.org/bot")
+TELEGRAM_FILE_URL = os.getenv("TELEGRAM_FILE_URL", "https://api.telegram.org/file/bot")
+
+# --- মেট্রিক্স (Prometheus, /metrics এ প্রকাশিত) ---
+_FAST_BUCKETS = (.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+HANDLER_SECONDS = Histogram('bot_handler_seconds', 'Handler latency', ['handler'])
+HANDLER_ERRORS = MetricCounter('bot_handler_errors_total', 'Handler exceptions', ['handler'])
+DB_QUERY_SECONDS = Histogram('bot_db_query_seconds', 'Time spent in a DB function (including pool wait)', ['query'], buckets=_FAST_BUCKETS)
+DB_EXECUTOR_WAIT_SECONDS = Histogram('bot_db_executor_wait_seconds', 'Time a DB call waited for an executor thread', buckets=_FAST_BUCKETS)
+DB_ACQUIRE_SECONDS = Histogram('bot_db_acquire_seconds', 'Time to check out a pooled connection', buckets=_FAST_BUCKETS)
+DB_FLUSH_SECONDS = Histogram('bot_buffer_flush_seconds', 'Write-behind buffer flush time', ['buffer'])
+BOT_API_SECONDS = Histogram('bot_api_call_seconds', 'Bot API call latency', ['method'])
+BOT_API_CALLS = MetricCounter('bot_api_calls_total', 'Bot API calls by outcome', ['method', 'outcome'])
+BOT_API_RETRY_AFTER = MetricCounter('bot_api_retry_after_total', 'RetryAfter (429) responses', ['method'])
+QUEUE_DEPTH = Gauge('bot_queue_depth', 'Items waiting in internal queues', ['queue'])
+
+def timed_handler(func):
+    """হ্যান্ডলারের সময় ও এক্সেপশন মেট্রিক্সে লেখে"""
+    name = func.__name__
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await func(*args, **kwargs)
+        except Exception:
+            HANDLER_ERRORS.labels(name).inc()
+            raise
+        finally:
+            HANDLER_SECONDS.labels(name).observe(time.perf_counter() - started)
+    return wrapper
+
+# ডেটাবেস কানেকশন পুল সেটিংস
+DB_POOL_MIN = int(os.getenv("DB_POOL_MIN", 1))
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", 10))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", 10))
+DB_HEALTHCHECK_INTERVAL = float(os.getenv("DB_HEALTHCHECK_INTERVAL", 30))
+DB_SSLMODE = os.getenv("DB_SSLMODE", "require")
+
+# একাধিক ওয়ার্কার চললে প্রতিটির আলাদা পরিচয় (ব্রডকাস্ট জবের লিজ মালিকানার জন্য)
+WORKER_ID = os.getenv("WORKER_ID") or f"{socket.gethostname()}-{os.getpid()}"
+
+class DBPool:
+    """ThreadedConnectionPool এর উপর অপেক্ষা, হেলথ চেক ও রিকানেক্ট সহ শেয়ার্ড পুল।
+    connect_kwargs সরাসরি psycopg2.connect এ যায় (যেমন connection_factory)।"""
+
+    def __init__(self, dsn, minconn, maxconn, timeout, **connect_kwargs):
+        self.dsn, self.minconn, self.maxconn, self.timeout = dsn, minconn, maxconn, timeout
+        self.connect_kwargs = connect_kwargs
+        self._pool = None
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(maxconn)
+        self._last_ok = {}
+        self.checkouts = 0
+        self.timeouts = 0
+        self.reconnects = 0
+        self.in_use = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def _get_pool(self):
+        with self._lock:
+            if self._pool is None or self._pool.closed:
+                self._pool = pg_pool.ThreadedConnectionPool(
+                    self.minconn, self.maxconn, self.dsn, sslmode=DB_SSLMODE, connect_timeout=10, **self.connect_kwargs
+                )
+            return self._pool
+
+    def _healthy(self, conn):
+        """অনেকক্ষণ অলস থাকা কানেকশন ব্যবহারের আগে SELECT 1 দিয়ে যাচাই করে"""
+        if conn.closed: return False
+        last_ok = self._last_ok.get(id(conn))
+        if last_ok is not None and time.monotonic() - last_ok < DB_HEALTHCHECK_INTERVAL: return True
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def getconn(self):
+        started = time.monotonic()
+        if not self._slots.acquire(timeout=self.timeout):
+            with self._lock: self.timeouts += 1
+            raise pg_pool.PoolError(f"no connection available within {self.timeout}s")
+        try:
+            pool = self._get_pool()
+            # ডিবি রিস্টার্টের পর পুলের সব আইডল কানেকশনই ভাঙা থাকতে পারে; সেগুলো একে একে ফেলে দিয়ে
+            # সুস্থ বা নতুন কানেকশন না পাওয়া পর্যন্ত চেষ্টা (সর্বোচ্চ maxconn টি ফেলে দেওয়ার পর নতুন কানেক্ট হয়)
+            for _ in range(self.maxconn + 1):
+                conn = pool.getconn()
+                if self._healthy(conn): break
+                self._last_ok.pop(id(conn), None)
+                pool.putconn(conn, close=True)
+                with self._lock: self.reconnects += 1
+            else:
+                raise pg_pool.PoolError("no healthy connection available")
+        except Exception:
+            self._slots.release()
+            raise
+        waited = time.monotonic() - started
+        DB_ACQUIRE_SECONDS.observe(waited)
+        with self._lock:
+            self.checkouts += 1
+            self.in_use += 1
+            self.wait_total += waited
+            self.wait_max = max(self.wait_max, waited)
+        return conn
+
+    def putconn(self, conn):
+        try:
+            broken = bool(conn.closed)
+            if not broken:
+                try: conn.rollback()
+                except psycopg2.Error: broken = True
+            if broken: self._last_ok.pop(id(conn), None)
+            else: self._last_ok[id(conn)] = time.monotonic()
+            with self._lock: pool = self._pool
+            if pool is not None and not pool.closed:
+                pool.putconn(conn, close=broken)
+            elif not conn.closed:
+                conn.close()
+        finally:
+            with self._lock: self.in_use -= 1
+            self._slots.release()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "min": self.minconn,
+                "max": self.maxconn,
+                "in_use": self.in_use,
+                "checkouts": self.checkouts,
+                "timeouts": self.timeouts,
+                "reconnects": self.reconnects,
+                "wait_avg_ms": round(self.wait_total / self.checkouts * 1000, 2) if self.checkouts else 0.0,
+                "wait_max_ms": round(self.wait_max * 1000, 2),
+            }
+
+    def closeall(self):
+        with self._lock:
+            if self._pool is not None and not self._pool.closed:
+                self._pool.closeall()
+
+db_pool = None
+_db_pool_lock = threading.Lock()
+
+def get_db_pool():
+    global db_pool
+    with _db_pool_lock:
+        if db_pool is None:
+            url = DATABASE_URL
+            if url.startswith("postgres://"):
+                url = url.replace("postgres://", "postgresql://", 1)
+            db_pool = DBPool(url, DB_POOL_MIN, DB_POOL_MAX, DB_POOL_TIMEOUT)
+        return db_pool
 
 def get_db_connection():
-    """ডেটাবেস কানেকশন স্থাপন করে"""
+    """পুল থেকে ডেটাবেস কানেকশন নেয় (কাজ শেষে release_db_connection দিয়ে ফেরত দিতে হবে)"""
     if not DATABASE_URL:
         logger.error("DATABASE_URL variable missing!")
         return None
     try:
-        url = DATABASE_URL
-        if url.startswith("postgres://"):
-            url = url.replace("postgres://", "postgresql://", 1)
-        conn = psycopg2.connect(url, sslmode='require', connect_timeout=10)
-        return conn
+        return get_db_pool().getconn()
     except Exception as e:
         logger.error(f"DB Error: {e}")
         return None
 
+def release_db_connection(conn):
+    """কানেকশন পুলে ফেরত দেয়"""
+    get_db_pool().putconn(conn)
+
+# --- অ্যাসিঙ্ক ডেটা অ্যাক্সেস লেয়ার ---
+# সব হ্যান্ডলার run_db দিয়ে কুয়েরি চালায়, যাতে ধীর কুয়েরি ইভেন্ট লুপ আটকে না রাখে।
+# Users, AppHits ও BotState ফ্লাশার থ্রেড এক্সিকিউটরের বাইরে একই পুল থেকে কানেকশন নেয়, তাই তাদের জন্য
+# DB_FLUSHER_CONNECTIONS টি রেখে বাকিগুলো এক্সিকিউটরের। এতে এক্সিকিউটরের থ্রেড পুলের অপেক্ষায় বসে না;
+# লম্বা কাজ (যেমন সেগমেন্ট রিফ্রেশের লকের অপেক্ষা) একটি থ্রেড আটকালে বাকি কাজ এক্সিকিউটরের লাইনে দাঁড়ায়।
+DB_FLUSHER_CONNECTIONS = 3
+DB_EXECUTOR_WORKERS = int(os.getenv("DB_EXECUTOR_WORKERS", max(1, DB_POOL_MAX - DB_FLUSHER_CONNECTIONS)))
+CONCURRENT_UPDATES = int(os.getenv("CONCURRENT_UPDATES", 64))
+db_executor = ThreadPoolExecutor(max_workers=DB_EXECUTOR_WORKERS, thread_name_prefix="db")
+QUEUE_DEPTH.labels('db_executor').set_function(lambda: db_executor._work_queue.qsize())
+Gauge('bot_db_connections_in_use', 'Pooled connections checked out').set_function(lambda: db_pool.in_use if db_pool else 0)
+
+def _timed_db_call(func, submitted, args, kwargs):
+    started = time.perf_counter()
+    DB_EXECUTOR_WAIT_SECONDS.observe(started - submitted)
+    try: return func(*args, **kwargs)
+    finally: DB_QUERY_SECONDS.labels(getattr(func, '__name__', 'unknown')).observe(time.perf_counter() - started)
+
+async def run_db(func, *args, **kwargs):
+    """সিঙ্ক্রোনাস ডেটাবেস ফাংশন সীমিত থ্রেড পুলে চালায়"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(db_executor, _timed_db_call, func, time.perf_counter(), args, kwargs)
+
+# ব্যাকগ্রাউন্ড টাস্ক (ব্রডকাস্ট, মেইনটেন্যান্স) - Application.create_task এর মতো stop() এ অপেক্ষা করে না,
+# বন্ধ হওয়ার সময় ক্যান্সেল হয় এবং চেকপয়েন্ট থেকে পরের বার আবার চলে
+_background_tasks = set()
+
+def start_background_task(coro, name):
+    task = asyncio.get_running_loop().create_task(coro, name=name)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
+
+async def cancel_background_tasks():
+    tasks = list(_background_tasks)
+    for task in tasks: task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+def try_advisory_lock(cur, name):
+    """সেশন-লেভেল অ্যাডভাইজরি লক; একাধিক ওয়ার্কারের মধ্যে একটিই পাবে (কাজ শেষে advisory_unlock করতে হবে)"""
+    cur.execute("SELECT pg_try_advisory_lock(hashtext(%s))", (name,))
+    return cur.fetchone()[0]
+
+def wait_advisory_lock(conn, cur, name, poll, timeout=None):
+    """লক না পাওয়া পর্যন্ত বিরতি দিয়ে try_advisory_lock চেষ্টা করে; অপেক্ষার সময় কোনো ট্রানজ্যাকশন খোলা থাকে না।
+    timeout পেরোলে False"""
+    deadline = None if timeout is None else time.monotonic() + timeout
+    while not try_advisory_lock(cur, name):
+        conn.rollback()
+        if deadline is not None and time.monotonic() >= deadline: return False
+        time.sleep(poll)
+    return True
+
+def advisory_unlock(cur, name):
+    cur.execute("SELECT pg_advisory_unlock(hashtext(%s))", (name,))
+
+async def run_periodic(func, interval, name, run_now=False):
+    """সিঙ্ক ডেটাবেস কাজ নির্দিষ্ট বিরতিতে চালায় (run_now হলে প্রথমবার সাথে সাথে)"""
+    while True:
+        if not run_now: await asyncio.sleep(interval)
+        run_now = False
+        try: await run_db(func)
+        except Exception as e: logger.error(f"{name} Error: {e}")
+
+class WriteBehindBuffer:
+    """মেমরিতে রেকর্ড জমিয়ে সাইজ বা সময় পূর্ণ হলে ব্যাকগ্রাউন্ড থ্রেডে একসাথে ফ্লাশ করে।
+    flush_func ব্যর্থ হলে (False বা exception) রেকর্ডগুলো আবার লাইনে ফিরে যায়, max_backlog পর্যন্ত।
+    key দেওয়া থাকলে একই key এর রেকর্ড একত্র হয় (শেষেরটি থাকে)।"""
+
+    def __init__(self, name, flush_func, max_size, interval, max_backlog=None, key=None):
+        self.name, self.flush_func, self.max_size, self.interval = name, flush_func, max_size, interval
+        self.max_backlog = max_backlog or max_size * 20
+        self.key = key
+        self._items = self._empty()
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def __len__(self):
+        with self._lock: return len(self._items)
+
+    def __contains__(self, key):
+        """key দেওয়া বাফারে এই key এর রেকর্ড এখনো ফ্লাশের অপেক্ষায় আছে কিনা"""
+        with self._lock: return key in self._items
+
+    def _empty(self):
+        return OrderedDict() if self.key else []
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name=f"{self.name}-flusher", daemon=True)
+            self._thread.start()
+
+    def add(self, item):
+        with self._lock:
+            if self.key:
+                self._items.pop(self.key(item), None)
+                self._items[self.key(item)] = item
+            else:
+                self._items.append(item)
+            full = len(self._items) >= self.max_size
+        if full: self._wakeup.set()
+
+    def _run(self):
+        while not self._stopped.is_set():
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            self.flush()
+
+    def flush(self):
+        with self._flush_lock:
+            with self._lock:
+                pending, self._items = self._items, self._empty()
+            if not pending: return
+            items = list(pending.values()) if self.key else pending
+            started = time.perf_counter()
+            try: ok = self.flush_func(items)
+            except Exception as e:
+                logger.error(f"{self.name} Flush Error: {e}")
+                ok = False
+            DB_FLUSH_SECONDS.labels(self.name).observe(time.perf_counter() - started)
+            if ok is False:
+                with self._lock:
+                    if self.key:
+                        # ফ্লাশের মাঝে আসা নতুন রেকর্ড পুরোনোটির চেয়ে অগ্রাধিকার পায়
+                        for k, item in self._items.items(): pending[k] = item
+                        self._items = pending
+                        while len(self._items) > self.max_backlog: self._items.popitem(last=False)
+                    else:
+                        self._items[:0] = items
+                        dropped = len(self._items) - self.max_backlog
+                        if dropped > 0:
+                            del self._items[:dropped]
+                            logger.error(f"{self.name} backlog full, dropped {dropped} records")
+
+    def stop(self):
+        """থ্রেড বন্ধ করে বাকি রেকর্ড ফ্লাশ করে"""
+        self._stopped.set()
+        self._wakeup.set()
+        if self._thread is not None: self._thread.join(timeout=self.interval + 5)
+        self.flush()
+
+class LRUCache:
+    """থ্রেড-সেফ LRU ক্যাশ; maxsize ছাড়ালে সবচেয়ে পুরোনো ব্যবহৃত এন্ট্রি বাদ যায়"""
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        with self._lock: return len(self._data)
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key in self._data:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return self._data[key]
+            self.misses += 1
+            return default
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize: self._data.popitem(last=False)
+
+    def pop(self, key):
+        with self._lock: self._data.pop(key, None)
+
 # কথোপকথনের ধাপ (States)
 GET_MEDIA, GET_TITLE, GET_CUSTOM_CODE, GET_BROADCAST_MSG, SET_BTN_NAME, SET_BTN_URL = range(6)
 
-def init_db():
-    """প্রয়োজনীয় টেবিল এবং কলাম তৈরি বা অটো-আপডেট করে"""
+# --- স্কিমা মাইগ্রেশন ---
+# প্রতিটি মাইগ্রেশন একবারই চলে এবং schema_version এ লেখা থাকে। স্কিমা হালনাগাদ থাকলে স্টার্টআপে
+# একটি কুয়েরিতেই শেষ, হট টেবিলে কোনো লক নেয় না। নতুন স্কিমা পরিবর্তন MIGRATIONS এর শেষে নতুন সংস্করণ হিসেবে যোগ হয়।
+# transactional=False মাইগ্রেশন autocommit এ চলে (CREATE INDEX CONCURRENTLY এর জন্য), তাই আবার চালানো নিরাপদ হতে হবে।
+MIGRATION_LOCK_POLL = 1.0
+
+def migration_0001_baseline(cur):
+    """আগের init_db এর টেবিল ও কলাম (বিদ্যমান ডেটাবেসে IF NOT EXISTS দিয়ে নিরাপদ)"""
+    # ইউজার টেবিল
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS users (
+            user_id BIGINT PRIMARY KEY,
+            username TEXT,
+            full_name TEXT,
+            joined_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    cur.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS joined_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP")
+    cur.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS full_name TEXT")
+    cur.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS is_active BOOLEAN DEFAULT TRUE")
+
+    # অ্যাপ লগ টেবিল (ইউনিক ট্র্যাকিং) - last_open অনুযায়ী মাসিক পার্টিশন
+    cur.execute("ALTER TABLE IF EXISTS app_logs ADD COLUMN IF NOT EXISTS last_open TIMESTAMP DEFAULT CURRENT_TIMESTAMP")
+    ensure_partitioned_table(cur, 'app_logs', 'last_open', "user_id BIGINT, last_open TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP")
+
+    # অ্যাপ হিটস টেবিল (টোটাল ট্র্যাকিং) - hit_time অনুযায়ী মাসিক পার্টিশন
+    ensure_partitioned_table(cur, 'app_hits', 'hit_time', "user_id BIGINT, hit_time TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP")
+    for table in PARTITIONED_TABLES: ensure_partitions(cur, table)
+
+    # পুরোনো পার্টিশন কমপ্যাক্ট করার পর ইউজার/দিন ভিত্তিক হিসাব
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS app_usage_daily (
+            user_id BIGINT NOT NULL,
+            day DATE NOT NULL,
+            hits INTEGER NOT NULL DEFAULT 0,
+            unique_opens INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (user_id, day)
+        )
+    """)
+
+    # ফাইল টেবিল
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS files (
+            custom_code TEXT PRIMARY KEY,
+            title TEXT,
+            file_type TEXT,
+            file_id TEXT
+        )
+    """)
+    cur.execute("ALTER TABLE files ADD COLUMN IF NOT EXISTS created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP")
+    ensure_link_indexes(cur)
+
+    # বান্ডেলের আইটেম টেবিল (ক্রমানুসারে প্রতিটি কন্টেন্ট আলাদা রো)
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS file_items (
+            custom_code TEXT NOT NULL REFERENCES files (custom_code) ON DELETE CASCADE,
+            position INTEGER NOT NULL,
+            item_type TEXT NOT NULL,
+            item_value TEXT NOT NULL,
+            PRIMARY KEY (custom_code, position)
+        )
+    """)
+    migrate_legacy_bundles(cur)
+
+    # সেটিংস টেবিল
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS settings (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        )
+    """)
+
+    # ব্রডকাস্ট জব টেবিল (রিজিউম করার জন্য চেকপয়েন্ট)
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS broadcast_jobs (
+            job_id SERIAL PRIMARY KEY,
+            from_chat_id BIGINT NOT NULL,
+            message_id BIGINT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'running',
+            last_user_id BIGINT NOT NULL DEFAULT 0,
+            total INTEGER NOT NULL DEFAULT 0,
+            sent INTEGER NOT NULL DEFAULT 0,
+            failed INTEGER NOT NULL DEFAULT 0,
+            blocked INTEGER NOT NULL DEFAULT 0,
+            progress_chat_id BIGINT,
+            progress_message_id BIGINT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    # যে ওয়ার্কার জবটি চালাচ্ছে এবং তার লিজ কতক্ষণ বৈধ
+    cur.execute("ALTER TABLE broadcast_jobs ADD COLUMN IF NOT EXISTS owner TEXT")
+    cur.execute("ALTER TABLE broadcast_jobs ADD COLUMN IF NOT EXISTS lease_until TIMESTAMP")
+
+    # কনভারসেশন ও user_data এর স্থায়ী স্টেট (PostgresPersistence)
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS bot_state (
+            kind TEXT NOT NULL,
+            key TEXT NOT NULL,
+            data JSONB NOT NULL,
+            version BIGINT NOT NULL DEFAULT 1,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (kind, key)
+        )
+    """)
+
+    # পরিসংখ্যান রোলআপ: লাইফটাইম কাউন্টার ও ঘণ্টাভিত্তিক বাকেট
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS stats_counters (
+            name TEXT PRIMARY KEY,
+            value BIGINT NOT NULL DEFAULT 0
+        )
+    """)
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS stats_hourly (
+            bucket TIMESTAMP NOT NULL,
+            metric TEXT NOT NULL,
+            value BIGINT NOT NULL DEFAULT 0,
+            PRIMARY KEY (bucket, metric)
+        )
+    """)
+    seed_stats_rollups(cur)
+
+def migration_0002_hot_indexes(cur):
+    """হট কুয়েরির ইনডেক্স, লেখা না আটকে কনকারেন্টলি তৈরি"""
+    # নতুন ইউজারের দৈনিক হিসাব ও রোলআপ সিড
+    create_index_concurrently(cur, 'idx_users_joined_at', 'users', 'joined_at')
+    create_index_concurrently(cur, 'idx_app_hits_hit_time', 'app_hits', 'hit_time')
+    # স্টার্টআপে গত ২৪ ঘণ্টার ওপেন লোড করার জন্য
+    create_index_concurrently(cur, 'idx_app_logs_last_open', 'app_logs', 'last_open')
+    # হিট ফ্লাশে ইউজারের শেষ ইউনিক ওপেন খোঁজা
+    create_index_concurrently(cur, 'idx_app_logs_user_last_open', 'app_logs', 'user_id, last_open')
+
+def migration_0003_segments(cur):
+    """ব্রডকাস্টের অডিয়েন্স সেগমেন্ট ও আগে থেকে হিসাব করা প্রাপক তালিকা"""
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS segments (
+            name TEXT PRIMARY KEY,
+            kind TEXT NOT NULL,
+            param TEXT NOT NULL,
+            size INTEGER NOT NULL DEFAULT 0,
+            refreshed_until TIMESTAMP,
+            refreshed_at TIMESTAMP,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS segment_members (
+            segment TEXT NOT NULL REFERENCES segments (name) ON DELETE CASCADE,
+            user_id BIGINT NOT NULL,
+            last_seen TIMESTAMP NOT NULL,
+            PRIMARY KEY (segment, user_id)
+        )
+    """)
+    cur.execute("ALTER TABLE broadcast_jobs ADD COLUMN IF NOT EXISTS segment TEXT")
+
+# (সংস্করণ, বিবরণ, ফাংশন, ট্রানজ্যাকশনে চলবে কিনা)
+MIGRATIONS = [
+    (1, "baseline schema", migration_0001_baseline, True),
+    (2, "hot query indexes", migration_0002_hot_indexes, False),
+    (3, "audience segments", migration_0003_segments, True),
+]
+
+def _drop_invalid_index(cur, name):
+    """ব্যর্থ কনকারেন্ট বিল্ডের INVALID ইনডেক্স মুছে ফেলে (পার্টিশনড প্যারেন্ট ইনডেক্স বাদে)"""
+    cur.execute("""
+        SELECT 1 FROM pg_index x JOIN pg_class c ON c.oid = x.indexrelid
+        WHERE x.indexrelid = to_regclass(%s) AND NOT x.indisvalid AND c.relkind = 'i'
+    """, (name,))
+    if cur.fetchone(): cur.execute(f"DROP INDEX CONCURRENTLY {name}")
+
+def create_index_concurrently(cur, name, table, columns):
+    """autocommit কানেকশনে ইনডেক্স কনকারেন্টলি তৈরি করে। পার্টিশনড টেবিলে তা সরাসরি সম্ভব নয়, তাই
+    প্যারেন্টে ON ONLY ইনডেক্স, প্রতিটি পার্টিশনে আলাদা কনকারেন্ট ইনডেক্স ও ATTACH (সব অ্যাটাচ হলে প্যারেন্ট valid হয়)"""
+    cur.execute("SELECT relkind FROM pg_class WHERE oid = to_regclass(%s)", (table,))
+    if cur.fetchone()[0] != 'p':
+        _drop_invalid_index(cur, name)
+        cur.execute(f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} ON {table} ({columns})")
+        return
+    cur.execute(f"CREATE INDEX IF NOT EXISTS {name} ON ONLY {table} ({columns})")
+    cur.execute("""
+        SELECT x.indrelid::regclass::text FROM pg_inherits i JOIN pg_index x ON x.indexrelid = i.inhrelid
+        WHERE i.inhparent = to_regclass(%s)
+    """, (name,))
+    attached = {row[0] for row in cur.fetchall()}
+    for partition, _, _ in list_partitions(cur, table):
+        if partition in attached: continue
+        index = f"{name}_{partition.removeprefix(table + '_')}"
+        _drop_invalid_index(cur, index)
+        cur.execute(f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {index} ON {partition} ({columns})")
+        cur.execute(f"ALTER INDEX {name} ATTACH PARTITION {index}")
+
+def _schema_version(cur):
+    cur.execute("SELECT to_regclass('schema_version') IS NOT NULL")
+    if not cur.fetchone()[0]: return 0
+    cur.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version")
+    return cur.fetchone()[0]
+
+def apply_migrations(conn, cur):
+    # pg_advisory_lock এ অপেক্ষা করলে খোলা স্ন্যাপশট থাকে এবং অন্য ওয়ার্কারের CREATE INDEX CONCURRENTLY
+    # সেটির শেষ হওয়ার অপেক্ষায় আটকে যায়; তাই ট্রানজ্যাকশন ছাড়া বিরতি দিয়ে try_advisory_lock চেষ্টা করা হয়
+    wait_advisory_lock(conn, cur, 'schema_migrations', MIGRATION_LOCK_POLL)
+    try:
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS schema_version (
+                version INTEGER PRIMARY KEY,
+                description TEXT NOT NULL,
+                applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+        conn.commit()
+        # লকের জন্য অপেক্ষার সময় অন্য ওয়ার্কার হয়তো কাজ শেষ করেছে
+        current = _schema_version(cur)
+        conn.commit()
+        for version, description, migrate, transactional in MIGRATIONS:
+            if version <= current: continue
+            started = time.monotonic()
+            if transactional:
+                migrate(cur)
+                cur.execute("INSERT INTO schema_version (version, description) VALUES (%s, %s)", (version, description))
+                conn.commit()
+            else:
+                conn.autocommit = True
+                try:
+                    migrate(cur)
+                    cur.execute("INSERT INTO schema_version (version, description) VALUES (%s, %s)", (version, description))
+                finally: conn.autocommit = False
+            logger.info(f"Applied migration {version} ({description}) in {time.monotonic() - started:.1f}s.")
+    finally:
+        conn.rollback()
+        advisory_unlock(cur, 'schema_migrations')
+        conn.commit()
+
+def migrate_db():
+    """বাকি মাইগ্রেশনগুলো অ্যাডভাইজরি লকের অধীনে চালায়; স্কিমা হালনাগাদ থাকলে কিছুই করে না"""
     conn = get_db_connection()
-    if conn:
+    if not conn: return
+    try:
+        with conn.cursor() as cur:
+            if _schema_version(cur) < MIGRATIONS[-1][0]:
+                conn.rollback()
+                apply_migrations(conn, cur)
+            else:
+                logger.info("Database schema is up to date.")
+            detect_link_search(cur)
+            conn.commit()
+    except Exception as e: logger.error(f"DB Migration Error: {e}")
+    finally: release_db_connection(conn)
+
+# --- টাইম পার্টিশন ও রিটেনশন ---
+# app_hits ও app_logs মাসিক রেঞ্জ পার্টিশনে ভাগ করা। আগাম PARTITION_MONTHS_AHEAD মাসের পার্টিশন তৈরি থাকে।
+# HIT_RETENTION_DAYS এর চেয়ে পুরোনো পার্টিশন app_usage_daily তে কমপ্যাক্ট করে ড্রপ করা হয় (০ = চিরকাল রাখা)।
+# DEFAULT পার্টিশন নেই (থাকলে DETACH ... CONCURRENTLY চলে না); সীমার বাইরের রো insert_partitioned সামলায়।
+PARTITION_MONTHS_AHEAD = int(os.getenv("PARTITION_MONTHS_AHEAD", 2))
+HIT_RETENTION_DAYS = int(os.getenv("HIT_RETENTION_DAYS", 90))
+PARTITION_MAINTENANCE_INTERVAL = float(os.getenv("PARTITION_MAINTENANCE_INTERVAL", 6 * 3600))
+# টেবিল -> (পার্টিশন কলাম, app_usage_daily এর যে কলামে কমপ্যাক্ট হবে)
+PARTITIONED_TABLES = {'app_hits': ('hit_time', 'hits'), 'app_logs': ('last_open', 'unique_opens')}
+
+def _month_start(dt):
+    return dt.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+def _next_month(dt):
+    return _month_start(dt.replace(day=28) + timedelta(days=4))
+
+def list_partitions(cur, table):
+    """[(নাম, নিচের সীমা বা None, উপরের সীমা)] উপরের সীমা অনুযায়ী সাজানো"""
+    cur.execute("""
+        SELECT c.relname, pg_get_expr(c.relpartbound, c.oid)
+        FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = to_regclass(%s)
+    """, (table,))
+    partitions = []
+    for name, bound in cur.fetchall():
+        lower_expr, upper_expr = bound.split(' TO ')
+        lower = re.search(r"'([^']+)'", lower_expr)
+        upper = re.search(r"'([^']+)'", upper_expr)
+        if not upper: continue
+        partitions.append((name, datetime.fromisoformat(lower.group(1)) if lower else None, datetime.fromisoformat(upper.group(1))))
+    return sorted(partitions, key=lambda p: p[2])
+
+def ensure_partitioned_table(cur, table, column, columns_sql):
+    """টেবিল না থাকলে পার্টিশনড টেবিল তৈরি করে; পুরোনো সাধারণ টেবিল থাকলে সেটিকে লিগ্যাসি পার্টিশন বানায়"""
+    cur.execute("SELECT relkind FROM pg_class WHERE oid = to_regclass(%s)", (table,))
+    row = cur.fetchone()
+    if row and row[0] == 'p': return
+    if not row:
+        cur.execute(f"CREATE TABLE {table} ({columns_sql}) PARTITION BY RANGE ({column})")
+        return
+    # এককালীন রূপান্তর: পুরোনো ডেটা (MINVALUE থেকে পরের মাসের শুরু পর্যন্ত) একটি পার্টিশনে থাকে
+    legacy = f"{table}_legacy"
+    cur.execute(f"SELECT MAX({column}) FROM {table}")
+    newest = cur.fetchone()[0]
+    boundary = _next_month(max(newest or datetime.now(), datetime.now()))
+    cur.execute(f"ALTER TABLE {table} RENAME TO {legacy}")
+    cur.execute("SELECT indexname FROM pg_indexes WHERE tablename = %s", (legacy,))
+    for (index_name,) in cur.fetchall():
+        # নাম খালি করা, যাতে প্যারেন্টে একই নামের ইনডেক্স তৈরি হলে লিগ্যাসি ইনডেক্সটি অ্যাটাচ হয়
+        cur.execute(f"ALTER INDEX {index_name} RENAME TO {index_name}_legacy")
+    cur.execute(f"UPDATE {legacy} SET {column} = %s WHERE {column} IS NULL", (datetime(1970, 1, 1),))
+    cur.execute(f"ALTER TABLE {legacy} ALTER COLUMN {column} SET NOT NULL")
+    cur.execute(f"CREATE TABLE {table} ({columns_sql}) PARTITION BY RANGE ({column})")
+    cur.execute(f"ALTER TABLE {table} ATTACH PARTITION {legacy} FOR VALUES FROM (MINVALUE) TO (%s)", (boundary,))
+    logger.info(f"Converted {table} to a partitioned table.")
+
+def ensure_partitions(cur, table):
+    """শেষ পার্টিশনের পর থেকে চলতি মাস + PARTITION_MONTHS_AHEAD মাস পর্যন্ত পার্টিশন তৈরি করে"""
+    partitions = list_partitions(cur, table)
+    start = partitions[-1][2] if partitions else _month_start(datetime.now())
+    target = _month_start(datetime.now())
+    for _ in range(PARTITION_MONTHS_AHEAD + 1): target = _next_month(target)
+    while start < target:
+        end = _next_month(start)
+        cur.execute(
+            f"CREATE TABLE IF NOT EXISTS {table}_p{start:%Y%m} PARTITION OF {table} FOR VALUES FROM (%s) TO (%s)",
+            (start, end)
+        )
+        start = end
+
+def insert_partitioned(cur, table, columns, rows):
+    """পার্টিশনড টেবিলে মাল্টি-রো ইনসার্ট। কোনো রোর পার্টিশন না থাকলে (রক্ষণাবেক্ষণ পিছিয়ে থাকলে) আগাম পার্টিশন
+    তৈরি করে আবার চেষ্টা করে; তারপরও যে রো ডেটাবেস নেয় না (পার্টিশনের বাইরে বা অবৈধ মান) শুধু সেটি বাদ যায়,
+    যাতে একটি খারাপ রো পুরো ব্যাচকে বারবার ব্যর্থ না করে। লেখা রোগুলো ফেরত দেয়।"""
+    sql = f"INSERT INTO {table} ({columns}) VALUES %s"
+    for attempt in range(2):
+        cur.execute("SAVEPOINT partitioned_insert")
         try:
-            with conn.cursor() as cur:
-                # ইউজার টেবিল
-                cur.execute("""
-                    CREATE TABLE IF NOT EXISTS users (
-                        user_id BIGINT PRIMARY KEY,
-                        username TEXT,
-                        full_name TEXT,
-                        joined_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                    )
-                """)
-                cur.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS joined_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP")
-                cur.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS full_name TEXT")
-                
-                # অ্যাপ লগ টেবিল (ইউনিক ট্র্যাকিং)
-                cur.execute("""
-                    CREATE TABLE IF NOT EXISTS app_logs (
-                        user_id BIGINT,
-                        last_open TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                    )
-                """)
-                cur.execute("ALTER TABLE app_logs ADD COLUMN IF NOT EXISTS last_open TIMESTAMP DEFAULT CURRENT_TIMESTAMP")
-
-                # অ্যাপ হিটস টেবিল (টোটাল ট্র্যাকিং - নতুন)
-                cur.execute("""
-                    CREATE TABLE IF NOT EXISTS app_hits (
-                        user_id BIGINT,
-                        hit_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                    )
-                """)
-                
-                # ফাইল টেবিল
-                cur.execute("""
-                    CREATE TABLE IF NOT EXISTS files (
-                        custom_code TEXT PRIMARY KEY,
-                        title TEXT,
-                        file_type TEXT,
-                        file_id TEXT
-                    )
-                """)
+            psycopg2.extras.execute_values(cur, sql, rows, page_size=1000)
+            cur.execute("RELEASE SAVEPOINT partitioned_insert")
+            return rows
+        except psycopg2.errors.CheckViolation:
+            cur.execute("ROLLBACK TO SAVEPOINT partitioned_insert")
+        except (psycopg2.IntegrityError, psycopg2.DataError):
+            cur.execute("ROLLBACK TO SAVEPOINT partitioned_insert")
+            break
+        if attempt == 0: ensure_partitions(cur, table)
+    written, error = [], None
+    for row in rows:
+        cur.execute("SAVEPOINT partitioned_insert")
+        try:
+            cur.execute(sql, (tuple(row),))
+            cur.execute("RELEASE SAVEPOINT partitioned_insert")
+            written.append(row)
+        except (psycopg2.IntegrityError, psycopg2.DataError) as e:
+            cur.execute("ROLLBACK TO SAVEPOINT partitioned_insert")
+            error = e
+    logger.error(f"Dropped {len(rows) - len(written)} rejected {table} rows, last error: {str(error).strip()}")
+    return written
 
-                # সেটিংস টেবিল
-                cur.execute("""
-                    CREATE TABLE IF NOT EXISTS settings (
-                        key TEXT PRIMARY KEY,
-                        value TEXT
-                    )
-                """)
-                conn.commit()
-                logger.info("Database initialized successfully.")
-        except Exception as e: logger.error(f"DB Init Error: {e}")
-        finally: conn.close()
+def _detached_partitions(cur, table):
+    """ডিটাচ হয়েছে কিন্তু এখনো কমপ্যাক্ট ও ড্রপ হয়নি এমন পুরোনো পার্টিশন (আগের রান মাঝপথে থামলে)"""
+    cur.execute("""
+        SELECT relname FROM pg_class
+        WHERE relkind = 'r' AND NOT relispartition AND pg_table_is_visible(oid) AND (relname LIKE %s OR relname = %s)
+        ORDER BY relname
+    """, (f"{table}\\_p%", f"{table}_legacy"))
+    return [row[0] for row in cur.fetchall()]
+
+def compact_expired_partitions(cur, table):
+    """রিটেনশনের বাইরের পার্টিশন ডিটাচ করে app_usage_daily তে যোগ করে ড্রপ করে; ড্রপ হওয়া পার্টিশনের সংখ্যা ফেরত দেয়"""
+    if HIT_RETENTION_DAYS <= 0: return 0
+    conn = cur.connection
+    column, field = PARTITIONED_TABLES[table]
+    cutoff = datetime.now() - timedelta(days=HIT_RETENTION_DAYS)
+    expired = [name for name, _, upper in list_partitions(cur, table) if upper <= cutoff]
+    cur.execute(
+        "SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+        "WHERE i.inhparent = to_regclass(%s) AND i.inhdetachpending",
+        (table,)
+    )
+    pending = {row[0] for row in cur.fetchall()}
+    conn.commit()
+    # সংযুক্ত পার্টিশন ড্রপ করলে প্যারেন্টে ACCESS EXCLUSIVE লক লাগে এবং সব হিট ইনসার্ট আটকে যায়; CONCURRENTLY
+    # ডিটাচ শুধু চলমান কুয়েরির শেষ হওয়ার অপেক্ষা করে। এটি ট্রানজ্যাকশনের বাইরে চলে, আর আগের রানে অসমাপ্ত
+    # ডিটাচ FINALIZE দিয়ে শেষ হয়।
+    conn.autocommit = True
+    try:
+        for name in expired:
+            cur.execute(f"ALTER TABLE {table} DETACH PARTITION {name} {'FINALIZE' if name in pending else 'CONCURRENTLY'}")
+    finally: conn.autocommit = False
+    dropped = 0
+    for name in _detached_partitions(cur, table):
+        # কমপ্যাকশন ও ড্রপ একই ট্রানজ্যাকশনে, যাতে মাঝপথে থামলে ডেটা দুইবার যোগ না হয়
+        cur.execute(f"""
+            INSERT INTO app_usage_daily (user_id, day, {field})
+            SELECT user_id, {column}::date, COUNT(*) FROM {name} WHERE user_id IS NOT NULL GROUP BY 1, 2
+            ON CONFLICT (user_id, day) DO UPDATE SET {field} = app_usage_daily.{field} + EXCLUDED.{field}
+        """)
+        cur.execute(f"DROP TABLE {name}")
+        conn.commit()
+        dropped += 1
+        logger.info(f"Compacted and dropped partition {name}.")
+    return dropped
+
+def run_partition_maintenance():
+    """আগাম পার্টিশন তৈরি ও রিটেনশন প্রয়োগ (পর্যায়ক্রমে চলে; একাধিক ওয়ার্কারের মধ্যে একটিই চালায়)"""
+    conn = get_db_connection()
+    if not conn: return
+    try:
+        with conn.cursor() as cur:
+            if not try_advisory_lock(cur, 'partition_maintenance'): return
+            try:
+                for table in PARTITIONED_TABLES:
+                    ensure_partitions(cur, table)
+                    conn.commit()
+                    compact_expired_partitions(cur, table)
+            finally:
+                conn.rollback()
+                advisory_unlock(cur, 'partition_maintenance')
+    except Exception as e: logger.error(f"Partition Maintenance Error: {e}")
+    finally: release_db_connection(conn)
+
+# --- পরিসংখ্যান রোলআপ ---
+# /statics আর বড় টেবিলে COUNT(*) চালায় না। ইউজার যোগ হলে, হিট ফ্লাশ হলে বা লিঙ্ক তৈরি হলে
+# একই ট্রানজ্যাকশনে stats_counters (লাইফটাইম) ও stats_hourly (ঘণ্টাভিত্তিক) আপডেট হয়।
+STATS_DAYS = int(os.getenv("STATS_DAYS", 7))
+
+def bump_stats(cur, events):
+    """events: [(metric, timestamp, count)] অনুযায়ী রোলআপ বাড়ায়"""
+    hourly, totals = Counter(), Counter()
+    for metric, ts, n in events:
+        hourly[(ts.replace(minute=0, second=0, microsecond=0), metric)] += n
+        totals[metric] += n
+    if not totals: return
+    # একই ক্রমে লক নেওয়ার জন্য সাজানো, যাতে সমান্তরাল ফ্লাশে ডেডলক না হয়
+    psycopg2.extras.execute_values(
+        cur,
+        "INSERT INTO stats_hourly (bucket, metric, value) VALUES %s "
+        "ON CONFLICT (bucket, metric) DO UPDATE SET value = stats_hourly.value + EXCLUDED.value",
+        sorted((bucket, metric, n) for (bucket, metric), n in hourly.items())
+    )
+    psycopg2.extras.execute_values(
+        cur,
+        "INSERT INTO stats_counters (name, value) VALUES %s "
+        "ON CONFLICT (name) DO UPDATE SET value = stats_counters.value + EXCLUDED.value",
+        sorted(totals.items())
+    )
+
+def seed_stats_rollups(cur):
+    """প্রথমবার চালুর সময় বিদ্যমান টেবিল থেকে রোলআপ তৈরি করে (একবারই চলে)"""
+    cur.execute("SELECT 1 FROM stats_counters WHERE name = '_seeded'")
+    if cur.fetchone(): return
+    # লক নেওয়ার পরের স্ন্যাপশট থেকে গোনা হয় এবং মান ওভাররাইট হয়, তাই চলমান ফ্লাশ দুইবার গোনা হয় না
+    cur.execute("LOCK TABLE stats_counters, stats_hourly IN EXCLUSIVE MODE")
+    cur.execute("DELETE FROM stats_hourly")
+    cur.execute("""
+        INSERT INTO stats_hourly (bucket, metric, value)
+        SELECT date_trunc('hour', joined_at), 'users', COUNT(*) FROM users WHERE joined_at IS NOT NULL GROUP BY 1
+        UNION ALL
+        SELECT date_trunc('hour', last_open), 'unique_opens', COUNT(*) FROM app_logs WHERE last_open IS NOT NULL GROUP BY 1
+        UNION ALL
+        SELECT date_trunc('hour', hit_time), 'total_opens', COUNT(*) FROM app_hits WHERE hit_time IS NOT NULL GROUP BY 1
+    """)
+    cur.execute("""
+        INSERT INTO stats_counters (name, value)
+        SELECT 'users', COUNT(*) FROM users
+        UNION ALL SELECT 'unique_opens', COUNT(*) FROM app_logs
+        UNION ALL SELECT 'total_opens', COUNT(*) FROM app_hits
+        UNION ALL SELECT 'links', COUNT(*) FROM files
+        UNION ALL SELECT '_seeded', 1
+        ON CONFLICT (name) DO UPDATE SET value = EXCLUDED.value
+    """)
+    logger.info("Statistics rollups seeded.")
+
+# --- ইউজার সেভ (coalesced write-behind) ---
+# সম্প্রতি দেখা ইউজারের username/full_name না বদলালে কোনো লেখা হয় না। বাকিগুলো user_id অনুযায়ী
+# একত্র হয়ে USER_FLUSH_INTERVAL পরপর একটি মাল্টি-রো আপসার্টে যায়। ফ্লাশ সফল হলেই শুধু ইউজার "দেখা" হিসেবে
+# ক্যাশে ওঠে, যাতে ড্রপ বা ব্যর্থ ফ্লাশের ইউজার পরের মেসেজে আবার লেখা হয়।
+USER_SEEN_CACHE_SIZE = int(os.getenv("USER_SEEN_CACHE_SIZE", 100000))
+USER_FLUSH_SIZE = int(os.getenv("USER_FLUSH_SIZE", 1000))
+USER_FLUSH_INTERVAL = float(os.getenv("USER_FLUSH_INTERVAL", 5))
+
+user_seen_cache = LRUCache(USER_SEEN_CACHE_SIZE)
+
+def flush_users(rows):
+    """rows: [(user_id, username, full_name, seen_at)] - বদলানো বা নতুন ইউজার একসাথে আপসার্ট করে"""
+    conn = get_db_connection()
+    if not conn: return False
+    try:
+        with conn.cursor() as cur:
+            # user_id ক্রমে লেখা, যাতে সমান্তরাল ফ্লাশে ডেডলক না হয়; অপরিবর্তিত রো আপডেট হয় না
+            inserted = psycopg2.extras.execute_values(
+                cur,
+                "INSERT INTO users (user_id, username, full_name, joined_at) VALUES %s "
+                "ON CONFLICT (user_id) DO UPDATE SET username = EXCLUDED.username, full_name = EXCLUDED.full_name, is_active = TRUE "
+                "WHERE users.username IS DISTINCT FROM EXCLUDED.username OR users.full_name IS DISTINCT FROM EXCLUDED.full_name "
+                "OR users.is_active IS FALSE "
+                "RETURNING (xmax = 0), joined_at",
+                sorted(rows), fetch=True
+            )
+            # xmax = 0 মানে নতুন রো ইনসার্ট হয়েছে, অর্থাৎ নতুন ইউজার
+            bump_stats(cur, [('users', joined_at, 1) for is_new, joined_at in inserted if is_new])
+            conn.commit()
+        for user_id, username, full_name, _ in rows: user_seen_cache.set(user_id, (username, full_name))
+        return True
+    finally: release_db_connection(conn)
+
+user_buffer = WriteBehindBuffer("Users", flush_users, USER_FLUSH_SIZE, USER_FLUSH_INTERVAL, key=lambda row: row[0])
+QUEUE_DEPTH.labels('users').set_function(user_buffer.__len__)
 
 def save_user(user_id, username, full_name):
+    """ডেটাবেসে না গিয়ে সাথে সাথে ফেরত আসে"""
+    if user_seen_cache.get(user_id) == (username, full_name): return
+    user_buffer.add((user_id, username, full_name, datetime.now()))
+
+# --- মিনি অ্যাপ হিট ট্র্যাকিং (write-behind) ---
+# প্রতিটি হিট মেমরিতে জমা হয় এবং HIT_FLUSH_SIZE বা HIT_FLUSH_INTERVAL পূর্ণ হলে একসাথে ইনসার্ট হয়।
+# ২৪ ঘণ্টার ইউনিক চেক ডেটাবেসের বদলে _last_open ম্যাপ থেকে উত্তর দেওয়া হয়।
+HIT_FLUSH_SIZE = int(os.getenv("HIT_FLUSH_SIZE", 500))
+HIT_FLUSH_INTERVAL = float(os.getenv("HIT_FLUSH_INTERVAL", 2))
+BIGINT_MAX = 2**63 - 1
+UNIQUE_OPEN_WINDOW = timedelta(hours=24)
+
+_last_open = {}
+_last_open_lock = threading.Lock()
+_last_open_pruned = time.monotonic()
+
+def load_recent_app_opens():
+    """গত ২৪ ঘণ্টার শেষ ওপেন সময় দিয়ে _last_open ম্যাপ পূরণ করে"""
     conn = get_db_connection()
-    if conn:
-        try:
-            with conn.cursor() as cur:
+    if not conn: return
+    try:
+        with conn.cursor() as cur:
+            cur.execute(
+                "SELECT user_id, MAX(last_open) FROM app_logs WHERE last_open >= %s GROUP BY user_id",
+                (datetime.now() - UNIQUE_OPEN_WINDOW,)
+            )
+            rows = cur.fetchall()
+        with _last_open_lock:
+            for user_id, last_open in rows:
+                if last_open > _last_open.get(user_id, datetime.min): _last_open[user_id] = last_open
+        logger.info(f"Loaded {len(rows)} recent app opens.")
+    except Exception as e: logger.error(f"Load App Opens Error: {e}")
+    finally: release_db_connection(conn)
+
+def _prune_last_open():
+    global _last_open_pruned
+    if time.monotonic() - _last_open_pruned < 600: return
+    _last_open_pruned = time.monotonic()
+    cutoff = datetime.now() - UNIQUE_OPEN_WINDOW
+    with _last_open_lock:
+        for user_id in [u for u, t in _last_open.items() if t < cutoff]: del _last_open[user_id]
+
+def flush_app_hits(hits):
+    """জমে থাকা হিটগুলো মাল্টি-রো ইনসার্টে app_hits ও app_logs এ লেখে"""
+    conn = get_db_connection()
+    if not conn: return False
+    try:
+        with conn.cursor() as cur:
+            written = insert_partitioned(cur, 'app_hits', 'user_id, hit_time', [(u, t) for u, t, _ in hits])
+            uniques = [(u, t) for u, t, unique in hits if unique]
+            if uniques:
+                # অন্য ওয়ার্কার এই উইন্ডোতে আগেই ইউনিক ওপেন লিখে থাকলে সেটি আর ইউনিক নয়
                 cur.execute(
-                    "INSERT INTO users (user_id, username, full_name, joined_at) VALUES (%s, %s, %s, CURRENT_TIMESTAMP) "
-                    "ON CONFLICT (user_id) DO UPDATE SET username = EXCLUDED.username, full_name = EXCLUDED.full_name",
-                    (user_id, username, full_name)
+                    "SELECT user_id, MAX(last_open) FROM app_logs WHERE user_id = ANY(%s) AND last_open >= %s GROUP BY user_id",
+                    ([u for u, _ in uniques], min(t for _, t in uniques) - UNIQUE_OPEN_WINDOW)
                 )
-                conn.commit()
-        except Exception as e: logger.error(f"Save User Error: {e}")
-        finally: conn.close()
+                seen = dict(cur.fetchall())
+                uniques = [(u, t) for u, t in uniques if u not in seen or t - seen[u] >= UNIQUE_OPEN_WINDOW]
+                with _last_open_lock:
+                    for user_id, last_open in seen.items():
+                        if last_open > _last_open.get(user_id, datetime.min): _last_open[user_id] = last_open
+            if uniques: uniques = insert_partitioned(cur, 'app_logs', 'user_id, last_open', uniques)
+            bump_stats(cur, [('total_opens', t, 1) for _, t in written] + [('unique_opens', t, 1) for _, t in uniques])
+            conn.commit()
+    finally: release_db_connection(conn)
+    _prune_last_open()
+    return True
+
+hit_buffer = WriteBehindBuffer("AppHits", flush_app_hits, HIT_FLUSH_SIZE, HIT_FLUSH_INTERVAL)
+QUEUE_DEPTH.labels('hits').set_function(hit_buffer.__len__)
 
 def track_app_open(user_id):
-    """মিনি অ্যাপ ওপেন ট্র্যাকিং লজিক (ইউনিক এবং টোটাল উভয়ই)"""
-    conn = get_db_connection()
-    if conn:
+    """মিনি অ্যাপ ওপেন ট্র্যাকিং লজিক (ইউনিক এবং টোটাল উভয়ই) - ডেটাবেসে না গিয়ে সাথে সাথে ফেরত আসে"""
+    now = datetime.now()
+    with _last_open_lock:
+        last_open = _last_open.get(user_id)
+        unique = last_open is None or now - last_open >= UNIQUE_OPEN_WINDOW
+        if unique: _last_open[user_id] = now
+    hit_buffer.add((user_id, now, unique))
+
+# --- সেটিংস ক্যাশ ---
+SETTINGS_CACHE_TTL = float(os.getenv("SETTINGS_CACHE_TTL", 300))
+# set_setting প্রতিবার এই সংরক্ষিত রোর সংখ্যা বাড়ায়; প্রতিটি ওয়ার্কার SETTINGS_VERSION_POLL পরপর শুধু এই রো পড়ে
+# এবং বদলালে ক্যাশ আবার লোড করে, তাই অন্য ওয়ার্কারে করা পরিবর্তনও কয়েক সেকেন্ডে পৌঁছে যায়
+SETTINGS_VERSION_KEY = "_version"
+SETTINGS_VERSION_POLL = float(os.getenv("SETTINGS_VERSION_POLL", 5))
+
+class SettingsCache:
+    """settings টেবিলের ইন-প্রসেস ক্যাশ (key -> value)। টেবিল ছোট, তাই একবারে পুরোটা লোড হয়;
+    TTL শেষ হলে, set_setting চললে বা অন্য ওয়ার্কারে সেটিং বদলালে (SETTINGS_VERSION_KEY) আবার লোড হয়। get() কখনো ডেটাবেসে যায় না (ইভেন্ট লুপ থেকে নিরাপদ);
+    লোড সবসময় এক্সিকিউটরে হয় এবং ব্যর্থ হলে আগের মান থেকে যায়।"""
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._values = None
+        self._version = None
+        self._loaded_at = 0.0
+        self._lock = threading.Lock()
+
+    def is_fresh(self):
+        return self._values is not None and time.monotonic() - self._loaded_at < self.ttl
+
+    def load(self):
+        conn = get_db_connection()
+        if not conn: return
         try:
             with conn.cursor() as cur:
-                now = datetime.now()
-                
-                # ১. টোটাল ট্র্যাকিং: প্রতিটি ক্লিক সেভ হবে
-                cur.execute("INSERT INTO app_hits (user_id, hit_time) VALUES (%s, %s)", (user_id, now))
-
-                # ২. ইউনিক ট্র্যাকিং: ২৪ ঘণ্টা পর পর একবার সেভ হবে
-                cur.execute("SELECT MAX(last_open) FROM app_logs WHERE user_id = %s", (user_id,))
-                res = cur.fetchone()
-                if res[0] is None or (now - res[0] >= timedelta(hours=24)):
-                    cur.execute("INSERT INTO app_logs (user_id, last_open) VALUES (%s, %s)", (user_id, now))
-                
-                conn.commit()
-        except Exception as e: logger.error(f"Track App Error: {e}")
-        finally: conn.close()
+                cur.execute("SELECT key, value FROM settings")
+                values = dict(cur.fetchall())
+            version = values.pop(SETTINGS_VERSION_KEY, None)
+            with self._lock:
+                self._values, self._version, self._loaded_at = values, version, time.monotonic()
+        except Exception as e: logger.error(f"Settings Load Error: {e}")
+        finally: release_db_connection(conn)
 
-def get_setting(key, default):
-    conn = get_db_connection()
-    if conn:
+    def check_version(self):
+        """অন্য ওয়ার্কার সেটিং বদলালে আবার লোড করে (পর্যায়ক্রমে এক্সিকিউটরে চলে)"""
+        conn = get_db_connection()
+        if not conn: return
         try:
             with conn.cursor() as cur:
-                cur.execute("SELECT value FROM settings WHERE key = %s", (key,))
-                res = cur.fetchone()
-                return res[0] if res else default
-        finally: conn.close()
-    return default
+                cur.execute("SELECT value FROM settings WHERE key = %s", (SETTINGS_VERSION_KEY,))
+                row = cur.fetchone()
+        finally: release_db_connection(conn)
+        with self._lock: changed = self._values is not None and (row[0] if row else None) != self._version
+        if changed: self.load()
+
+    def invalidate(self):
+        """পরের get_setting_async এ আবার লোড হবে; ততক্ষণ (বা লোড ব্যর্থ হলে) আগের মান থাকে"""
+        with self._lock: self._loaded_at = 0.0
+
+    def get(self, key, default):
+        with self._lock:
+            return self._values.get(key, default) if self._values is not None else default
+
+settings_cache = SettingsCache(SETTINGS_CACHE_TTL)
+
+def get_setting(key, default):
+    """সিঙ্ক সংস্করণ - শুধু এক্সিকিউটর থ্রেড থেকে ডাকা যায়"""
+    if not settings_cache.is_fresh(): settings_cache.load()
+    return settings_cache.get(key, default)
+
+async def get_setting_async(key, default):
+    """ক্যাশ টাটকা থাকলে কোনো ডেটাবেস বা থ্রেড হপ ছাড়াই উত্তর দেয়"""
+    if not settings_cache.is_fresh(): await run_db(settings_cache.load)
+    return settings_cache.get(key, default)
 
 def set_setting(key, value):
     conn = get_db_connection()
@@ -154,18 +1053,779 @@ def set_setting(key, value):
         try:
             with conn.cursor() as cur:
                 cur.execute("INSERT INTO settings (key, value) VALUES (%s, %s) ON CONFLICT (key) DO UPDATE SET value = EXCLUDED.value", (key, value))
+                cur.execute(
+                    "INSERT INTO settings (key, value) VALUES (%s, '1') "
+                    "ON CONFLICT (key) DO UPDATE SET value = (settings.value::bigint + 1)::text",
+                    (SETTINGS_VERSION_KEY,)
+                )
                 conn.commit()
-        finally: conn.close()
+        finally:
+            release_db_connection(conn)
+            settings_cache.invalidate()
+
+# বটের username - post_init এ একবার লোড হয়, হ্যান্ডলারে get_me() কল লাগে না
+BOT_USERNAME = None
+
+def bot_link(query):
+    return f"https://t.me/{BOT_USERNAME}?{query}"
+
+# --- ফাইল বান্ডেল স্টোরেজ ---
+# পুরোনো "|" দিয়ে জোড়া file_type/file_id কলাম অপরিবর্তিত থাকে এবং নতুন বান্ডেলেও লেখা হয়, যাতে রোলিং ডিপ্লয়ের
+# সময় পুরোনো কোড চলতে পারে ও রোলব্যাক করা যায়। সব ওয়ার্কার নতুন কোডে গেলে পরের কোনো মাইগ্রেশন কলাম দুটি ড্রপ করবে।
+LEGACY_BUNDLES_SQL = """
+    SELECT f.custom_code, string_to_array(f.file_type, '|') AS types,
+           -- একটিমাত্র আইটেম হলে file_id ভাঙা হয় না, যাতে "|" সহ টেক্সট অক্ষত থাকে
+           CASE WHEN strpos(f.file_type, '|') > 0 THEN string_to_array(f.file_id, '|') ELSE ARRAY[f.file_id] END AS ids
+    FROM files f
+    WHERE f.file_type IS NOT NULL AND f.file_id IS NOT NULL
+      AND NOT EXISTS (SELECT 1 FROM file_items i WHERE i.custom_code = f.custom_code)
+"""
+
+def migrate_legacy_bundles(cur, code=None):
+    """পুরোনো file_type/file_id কলাম file_items এ ভেঙে কপি করে (আগে কপি হওয়া বান্ডেল বাদ); code দিলে শুধু সেটি।
+    কপি হওয়া আইটেমের সংখ্যা ফেরত দেয়।"""
+    only = "AND b.custom_code = %(code)s" if code else ""
+    # টাইপ ও আইডির সংখ্যা না মিললে (যেমন একাধিক আইটেমের বান্ডেলে "|" সহ টেক্সট) কোন আইটেম কোনটি বোঝা যায় না
+    cur.execute(
+        f"SELECT custom_code FROM ({LEGACY_BUNDLES_SQL}) b WHERE cardinality(types) <> cardinality(ids) {only} ORDER BY 1",
+        {'code': code}
+    )
+    skipped = [row[0] for row in cur.fetchall()]
+    if skipped:
+        logger.warning(f"Skipped {len(skipped)} legacy bundles with mismatched file_type/file_id: {', '.join(skipped[:20])}")
+    cur.execute(f"""
+        INSERT INTO file_items (custom_code, position, item_type, item_value)
+        SELECT b.custom_code, t.position, t.item_type, t.item_value
+        FROM ({LEGACY_BUNDLES_SQL}) b, unnest(b.types, b.ids) WITH ORDINALITY AS t(item_type, item_value, position)
+        WHERE cardinality(b.types) = cardinality(b.ids) {only}
+        ON CONFLICT DO NOTHING
+    """, {'code': code})
+    if cur.rowcount: logger.info(f"Migrated {cur.rowcount} legacy bundle items to file_items.")
+    return cur.rowcount
+
+def legacy_bundle_columns(items):
+    """(file_type, file_id) পুরোনো "|" ফরম্যাটে, পুরোনো কোডের জন্য"""
+    return "|".join(t for t, _ in items), "|".join(v for _, v in items)
+
+def fetch_file_bundle(code):
+    """কাস্টম কোডের বান্ডেল {'title', 'items': [(type, value)]} ফেরত দেয়"""
+    conn = get_db_connection()
+    if not conn: return None
+    try:
+        with conn.cursor() as cur:
+            sql = """
+                SELECT f.title, i.item_type, i.item_value
+                FROM files f LEFT JOIN file_items i ON i.custom_code = f.custom_code
+                WHERE f.custom_code = %s ORDER BY i.position
+            """
+            cur.execute(sql, (code,))
+            rows = cur.fetchall()
+            # রোলিং ডিপ্লয়ের সময় পুরোনো কোডে তৈরি বান্ডেলে শুধু file_type/file_id থাকে; প্রথম পড়ায় file_items এ কপি হয়
+            if rows and rows[0][1] is None and migrate_legacy_bundles(cur, code):
+                conn.commit()
+                cur.execute(sql, (code,))
+                rows = cur.fetchall()
+        if not rows: return None
+        return {'title': rows[0][0], 'items': [(t, v) for _, t, v in rows if t is not None]}
+    finally: release_db_connection(conn)
+
+# --- জনপ্রিয় কন্টেন্ট ক্যাশ ---
+BUNDLE_CACHE_SIZE = int(os.getenv("BUNDLE_CACHE_SIZE", 1024))
+
+bundle_cache = LRUCache(BUNDLE_CACHE_SIZE)
+
+async def load_bundle(code):
+    """কোডের বান্ডেল {'title', 'items': [(type, value)]} ক্যাশ থেকে, না থাকলে ডেটাবেস থেকে আনে"""
+    bundle = bundle_cache.get(code)
+    if bundle is None:
+        bundle = await run_db(fetch_file_bundle, code)
+        if not bundle: return None
+        bundle_cache.set(code, bundle)
+    return bundle
+
+def insert_file_bundle(code, title, files):
+    conn = get_db_connection()
+    if not conn: return False
+    try:
+        with conn.cursor() as cur:
+            cur.execute(
+                "INSERT INTO files (custom_code, title, file_type, file_id) VALUES (%s, %s, %s, %s)",
+                (code, title, *legacy_bundle_columns([(f['type'], f['id']) for f in files]))
+            )
+            psycopg2.extras.execute_values(
+                cur, "INSERT INTO file_items (custom_code, position, item_type, item_value) VALUES %s",
+                [(code, position, f['type'], f['id']) for position, f in enumerate(files, 1)]
+            )
+            bump_stats(cur, [('links', datetime.now(), 1)])
+            conn.commit()
+        bundle_cache.pop(code)
+        return True
+    finally: release_db_connection(conn)
+
+# --- বান্ডেল ইমপোর্ট/এক্সপোর্ট (JSONL) ---
+# প্রতি লাইনে একটি বান্ডেল: {"code": ..., "title": ..., "created_at": ..., "items": [{"type": ..., "value": ...}]}
+# ব্যবহার: python main.py export-bundles links.jsonl  |  python main.py import-bundles links.jsonl
+# নোট: টেলিগ্রামের file_id বট-নির্দিষ্ট, তাই একই বট টোকেনের এনভায়রনমেন্টের মধ্যেই সরানো যায়।
+BUNDLE_IMPORT_BATCH = 500
+
+def export_bundles(out):
+    """সব বান্ডেল সার্ভার-সাইড কার্সরে পড়ে JSONL হিসেবে লেখে; লেখা বান্ডেলের সংখ্যা ফেরত দেয়"""
+    conn = get_db_connection()
+    if not conn: return 0
+    count = 0
+    try:
+        with conn.cursor(name="export_bundles") as cur:
+            cur.itersize = BUNDLE_IMPORT_BATCH
+            cur.execute("""
+                SELECT f.custom_code, f.title, f.created_at,
+                       COALESCE(json_agg(json_build_object('type', i.item_type, 'value', i.item_value) ORDER BY i.position)
+                                FILTER (WHERE i.position IS NOT NULL), '[]')
+                FROM files f LEFT JOIN file_items i ON i.custom_code = f.custom_code
+                GROUP BY f.custom_code ORDER BY f.custom_code
+            """)
+            for code, title, created_at, items in cur:
+                out.write(json.dumps({
+                    'code': code, 'title': title,
+                    'created_at': created_at.isoformat() if created_at else None, 'items': items,
+                }, ensure_ascii=False) + "\n")
+                count += 1
+    finally: release_db_connection(conn)
+    return count
+
+def validate_bundle(bundle):
+    """ইমপোর্টের একটি বান্ডেল যাচাই করে; সমস্যা থাকলে কারণ, না থাকলে None ফেরত দেয়"""
+    if not isinstance(bundle, dict): return "not a JSON object"
+    code = bundle.get('code')
+    if not isinstance(code, str) or not code or code != code.strip(): return "missing or invalid code"
+    if bundle.get('title') is not None and not isinstance(bundle['title'], str): return "invalid title"
+    if bundle.get('created_at') is not None:
+        try: datetime.fromisoformat(bundle['created_at'])
+        except (TypeError, ValueError): return "invalid created_at"
+    items = bundle.get('items', [])
+    if not isinstance(items, list): return "items is not a list"
+    for position, item in enumerate(items, 1):
+        if not isinstance(item, dict) or item.get('type') not in SEND_METHOD: return f"item {position} has an unknown type"
+        if not isinstance(item.get('value'), str) or not item['value']: return f"item {position} has no value"
+    return None
+
+def _import_bundle_batch(cur, batch):
+    """একটি ব্যাচ ইনসার্ট করে; নতুন যোগ হওয়া কোডের সংখ্যা ফেরত দেয়"""
+    new_codes = {row[0] for row in psycopg2.extras.execute_values(
+        cur,
+        "INSERT INTO files (custom_code, title, created_at, file_type, file_id) VALUES %s "
+        "ON CONFLICT (custom_code) DO NOTHING RETURNING custom_code",
+        [
+            (b['code'], b.get('title'), b.get('created_at') or datetime.now(),
+             *legacy_bundle_columns([(item['type'], item['value']) for item in b.get('items', [])]))
+            for b in batch
+        ],
+        fetch=True
+    )}
+    items = [
+        (b['code'], position, item['type'], item['value'])
+        for b in batch if b['code'] in new_codes
+        for position, item in enumerate(b.get('items', []), 1)
+    ]
+    if items:
+        psycopg2.extras.execute_values(cur, "INSERT INTO file_items (custom_code, position, item_type, item_value) VALUES %s", items)
+    if new_codes: bump_stats(cur, [('links', datetime.now(), len(new_codes))])
+    cur.connection.commit()
+    return len(new_codes)
+
+def import_bundles(lines):
+    """JSONL থেকে বান্ডেল যোগ করে; আগে থেকে থাকা কোড, ফাইলে একই কোডের পরের লাইন ও ভুল লাইন বাদ দেয়।
+    (যোগ হয়েছে, বাদ গেছে) ফেরত দেয়"""
+    conn = get_db_connection()
+    if not conn: return 0, 0
+    imported = total = 0
+    codes = set()
+    try:
+        with conn.cursor() as cur:
+            batch = []
+            for number, line in enumerate(lines, 1):
+                if not line.strip(): continue
+                try:
+                    bundle = json.loads(line)
+                    problem = validate_bundle(bundle)
+                except ValueError as e: problem = f"invalid JSON ({e})"
+                if not problem and bundle['code'] in codes: problem = f"duplicate code {bundle['code']}"
+                if problem:
+                    logger.warning(f"Bundle import line {number} skipped: {problem}")
+                    total += 1
+                    continue
+                codes.add(bundle['code'])
+                batch.append(bundle)
+                if len(batch) >= BUNDLE_IMPORT_BATCH:
+                    imported += _import_bundle_batch(cur, batch)
+                    total += len(batch)
+                    batch = []
+            if batch:
+                imported += _import_bundle_batch(cur, batch)
+                total += len(batch)
+    finally: release_db_connection(conn)
+    return imported, total - imported
+
+# --- লিঙ্ক তালিকা (কিসেট পেজিং ও সার্চ) ---
+LINKS_PAGE_SIZE = int(os.getenv("LINKS_PAGE_SIZE", 10))
+# সাজানোর ধরন -> (সর্ট এক্সপ্রেশন, দিক); টাই ভাঙতে সবসময় custom_code যোগ হয়
+LINK_SORTS = {
+    'new': ("created_at", "DESC"),
+    'title': ("lower(COALESCE(title, custom_code))", "ASC"),
+}
+# pg_trgm পাওয়া গেলে যেকোনো অংশ দিয়ে খোঁজা যায়, না হলে শুধু শুরু (prefix) দিয়ে
+LINK_SEARCH_TRGM = False
+
+def ensure_link_indexes(cur):
+    """/alllink এর পেজিং ও সার্চের ইনডেক্স; pg_trgm এক্সটেনশন না থাকলে prefix ইনডেক্স দিয়ে চলে"""
+    global LINK_SEARCH_TRGM
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_files_created_at ON files (created_at, custom_code)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_files_title_sort ON files (lower(COALESCE(title, custom_code)), custom_code)")
+    cur.execute("SAVEPOINT link_trgm")
+    try:
+        cur.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+        cur.execute(
+            "CREATE INDEX IF NOT EXISTS idx_files_search_trgm ON files "
+            "USING gin ((COALESCE(title, '') || ' ' || custom_code) gin_trgm_ops)"
+        )
+        cur.execute("RELEASE SAVEPOINT link_trgm")
+        LINK_SEARCH_TRGM = True
+    except psycopg2.Error as e:
+        cur.execute("ROLLBACK TO SAVEPOINT link_trgm")
+        logger.warning(f"pg_trgm unavailable, link search falls back to prefix match: {e}")
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_files_title_prefix ON files (lower(COALESCE(title, custom_code)) text_pattern_ops)")
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_files_code_prefix ON files (lower(custom_code) text_pattern_ops)")
+        LINK_SEARCH_TRGM = False
+
+def detect_link_search(cur):
+    """মাইগ্রেশন আগেই হয়ে থাকলেও স্টার্টআপে জানা দরকার ট্রাইগ্রাম ইনডেক্স আছে কিনা"""
+    global LINK_SEARCH_TRGM
+    cur.execute("SELECT to_regclass('idx_files_search_trgm') IS NOT NULL")
+    LINK_SEARCH_TRGM = cur.fetchone()[0]
+
+def _like_escape(term):
+    return term.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+def fetch_links_page(sort='new', search=None, cursor=None, backward=False, limit=LINKS_PAGE_SIZE):
+    """cursor (sort_key, custom_code) এর পরের (backward হলে আগের) এক পৃষ্ঠা লিঙ্ক দেয়।
+    ফেরত: ([(custom_code, title, sort_key)], আরও আছে কিনা)"""
+    conn = get_db_connection()
+    if not conn: return None
+    expr, direction = LINK_SORTS[sort]
+    if backward: direction = "ASC" if direction == "DESC" else "DESC"
+    op = "<" if direction == "DESC" else ">"
+    where, params = [], []
+    if search:
+        term = _like_escape(search.lower())
+        if LINK_SEARCH_TRGM:
+            where.append("(COALESCE(title, '') || ' ' || custom_code) ILIKE %s")
+            params.append(f"%{term}%")
+        else:
+            where.append("(lower(COALESCE(title, custom_code)) LIKE %s OR lower(custom_code) LIKE %s)")
+            params += [f"{term}%", f"{term}%"]
+    if cursor:
+        where.append(f"({expr}, custom_code) {op} (%s, %s)")
+        params += list(cursor)
+    try:
+        with conn.cursor() as cur:
+            cur.execute(
+                f"SELECT custom_code, title, {expr} FROM files "
+                f"{'WHERE ' + ' AND '.join(where) if where else ''} "
+                f"ORDER BY {expr} {direction}, custom_code {direction} LIMIT %s",
+                params + [limit + 1]
+            )
+            rows = cur.fetchall()
+    finally: release_db_connection(conn)
+    more = len(rows) > limit
+    rows = [(c, t, k.isoformat() if isinstance(k, datetime) else k) for c, t, k in rows[:limit]]
+    if backward: rows.reverse()
+    return rows, more
+
+def count_active_users():
+    conn = get_db_connection()
+    if not conn: return None
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT COUNT(*) FROM users WHERE is_active IS NOT FALSE")
+            return cur.fetchone()[0]
+    finally: release_db_connection(conn)
+
+# ব্রডকাস্ট জবের লিজ: যে ওয়ার্কারের লিজ আছে শুধু সে-ই পাঠায়; প্রতি চেকপয়েন্টে এবং ব্যাচ চলাকালীন
+# BROADCAST_LEASE_SECONDS / 3 পরপর (হার্টবিট) লিজ নবায়ন হয়, তাই ধীর ব্যাচেও লিজ শেষ হয় না।
+# ওয়ার্কার মারা গেলে লিজ শেষ হওয়ার পর অন্য ওয়ার্কার জবটি দাবি করে চেকপয়েন্ট থেকে চালায়।
+BROADCAST_LEASE_SECONDS = int(os.getenv("BROADCAST_LEASE_SECONDS", 120))
+BROADCAST_CLAIM_INTERVAL = float(os.getenv("BROADCAST_CLAIM_INTERVAL", 60))
+
+def create_broadcast_job(from_chat_id, message_id, total, progress_chat_id, progress_message_id, segment=None):
+    conn = get_db_connection()
+    if not conn: return None
+    try:
+        with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
+            cur.execute(
+                "INSERT INTO broadcast_jobs (from_chat_id, message_id, total, progress_chat_id, progress_message_id, segment, owner, lease_until) "
+                "VALUES (%s, %s, %s, %s, %s, %s, %s, CURRENT_TIMESTAMP + make_interval(secs => %s)) RETURNING *",
+                (from_chat_id, message_id, total, progress_chat_id, progress_message_id, segment, WORKER_ID, BROADCAST_LEASE_SECONDS)
+            )
+            job = cur.fetchone()
+            conn.commit()
+            return job
+    finally: release_db_connection(conn)
+
+def claim_broadcast_jobs():
+    """মালিকহীন বা লিজ শেষ হওয়া চলমান জবগুলো এই ওয়ার্কারের নামে দাবি করে"""
+    conn = get_db_connection()
+    if not conn: return []
+    try:
+        with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
+            cur.execute(
+                "UPDATE broadcast_jobs SET owner = %s, lease_until = CURRENT_TIMESTAMP + make_interval(secs => %s) "
+                "WHERE status = 'running' AND (lease_until IS NULL OR lease_until < CURRENT_TIMESTAMP) RETURNING *",
+                (WORKER_ID, BROADCAST_LEASE_SECONDS)
+            )
+            jobs = cur.fetchall()
+            conn.commit()
+            return sorted(jobs, key=lambda job: job['job_id'])
+    finally: release_db_connection(conn)
+
+def release_broadcast_jobs():
+    """স্বাভাবিক বন্ধের সময় লিজ ছেড়ে দেয়, যাতে অন্য ওয়ার্কার অপেক্ষা ছাড়াই চালিয়ে নিতে পারে"""
+    conn = get_db_connection()
+    if not conn: return
+    try:
+        with conn.cursor() as cur:
+            cur.execute("UPDATE broadcast_jobs SET lease_until = NULL WHERE owner = %s AND status = 'running'", (WORKER_ID,))
+            conn.commit()
+    except Exception as e: logger.error(f"Broadcast Release Error: {e}")
+    finally: release_db_connection(conn)
+
+def renew_broadcast_lease(job_id):
+    """লিজ নবায়ন করে; জবটি আর এই ওয়ার্কারের না থাকলে False"""
+    conn = get_db_connection()
+    if not conn: return None
+    try:
+        with conn.cursor() as cur:
+            cur.execute(
+                "UPDATE broadcast_jobs SET lease_until = CURRENT_TIMESTAMP + make_interval(secs => %s) "
+                "WHERE job_id = %s AND owner = %s AND status = 'running'",
+                (BROADCAST_LEASE_SECONDS, job_id, WORKER_ID)
+            )
+            conn.commit()
+            return cur.rowcount > 0
+    except Exception as e: logger.error(f"Broadcast Lease Error: {e}")
+    finally: release_db_connection(conn)
+
+def fetch_broadcast_recipients(after_user_id, limit, segment=None):
+    """user_id অনুযায়ী কিসেট পেজিং - পুরো টেবিল একবারে মেমরিতে আনে না; segment দিলে শুধু তার সদস্যরা"""
+    conn = get_db_connection()
+    if not conn: return None
+    try:
+        with conn.cursor() as cur:
+            if segment:
+                cur.execute(
+                    "SELECT m.user_id FROM segment_members m JOIN users u ON u.user_id = m.user_id "
+                    "WHERE m.segment = %s AND m.user_id > %s AND u.is_active IS NOT FALSE ORDER BY m.user_id LIMIT %s",
+                    (segment, after_user_id, limit)
+                )
+            else:
+                cur.execute(
+                    "SELECT user_id FROM users WHERE user_id > %s AND is_active IS NOT FALSE ORDER BY user_id LIMIT %s",
+                    (after_user_id, limit)
+                )
+            return [row[0] for row in cur.fetchall()]
+    finally: release_db_connection(conn)
+
+def checkpoint_broadcast_job(job_id, last_user_id, counts, status, blocked_user_ids=()):
+    """ব্যাচ শেষে অগ্রগতি সেভ করে, লিজ নবায়ন করে এবং ব্লক করা ইউজারদের নিষ্ক্রিয় করে (একই ট্রানজ্যাকশনে)।
+    লিজ অন্য ওয়ার্কারের কাছে চলে গেলে False ফেরত দেয়।"""
+    conn = get_db_connection()
+    if not conn: return None
+    try:
+        with conn.cursor() as cur:
+            cur.execute(
+                "UPDATE broadcast_jobs SET last_user_id = %s, sent = %s, failed = %s, blocked = %s, status = %s, "
+                "lease_until = CURRENT_TIMESTAMP + make_interval(secs => %s), updated_at = CURRENT_TIMESTAMP "
+                "WHERE job_id = %s AND owner = %s",
+                (last_user_id, counts['sent'], counts['failed'], counts['blocked'], status, BROADCAST_LEASE_SECONDS, job_id, WORKER_ID)
+            )
+            if cur.rowcount == 0:
+                conn.rollback()
+                return False
+            if blocked_user_ids:
+                cur.execute("UPDATE users SET is_active = FALSE WHERE user_id = ANY(%s)", (list(blocked_user_ids),))
+            conn.commit()
+            return True
+    except Exception as e: logger.error(f"Broadcast Checkpoint Error: {e}")
+    finally: release_db_connection(conn)
+
+# --- অডিয়েন্স সেগমেন্ট ---
+# সেগমেন্টের সদস্যরা segment_members এ আগে থেকে হিসাব করা থাকে, তাই ব্রডকাস্টের সময় বড় app_logs/users
+# টেবিল জয়েন করতে হয় না। প্রতি রিফ্রেশে শুধু refreshed_until এর পরের রো পড়া হয় (বাফার ফ্লাশে দেরিতে আসা
+# রোর জন্য SEGMENT_REFRESH_LAG পেছন থেকে)।
+#   active_days N  - শেষ N দিনে মিনি অ্যাপ খুলেছে (app_logs), পুরোনো হলে বাদ যায়
+#   joined_after D - D তারিখ বা তার পরে যোগ দিয়েছে (users.joined_at)
+SEGMENT_KINDS = ('active_days', 'joined_after')
+SEGMENT_NAME = re.compile(r'^[a-z0-9_]{1,32}$')
+SEGMENT_REFRESH_INTERVAL = float(os.getenv("SEGMENT_REFRESH_INTERVAL", 900))
+SEGMENT_REFRESH_LAG = timedelta(minutes=10)
+# /segment ও /broadcast <সেগমেন্ট> চলমান রিফ্রেশ শেষ হওয়ার জন্য সর্বোচ্চ কতক্ষণ অপেক্ষা করবে
+SEGMENT_REFRESH_WAIT = float(os.getenv("SEGMENT_REFRESH_WAIT", 30))
+# app_logs এর পুরোনো পার্টিশন HIT_RETENTION_DAYS পরে ড্রপ হয়, তাই এর চেয়ে বড় উইন্ডোর সদস্য পুরো পাওয়া যায় না
+SEGMENT_MAX_DAYS = HIT_RETENTION_DAYS if HIT_RETENTION_DAYS > 0 else 365
+
+def parse_segment_param(kind, param):
+    """সঠিক হলে স্বাভাবিক রূপে param ফেরত দেয়, না হলে None"""
+    try:
+        if kind == 'active_days':
+            days = int(param)
+            return str(days) if 1 <= days <= SEGMENT_MAX_DAYS else None
+        if kind == 'joined_after':
+            return datetime.strptime(param, '%Y-%m-%d').date().isoformat()
+    except ValueError: return None
+    return None
+
+def _refresh_segment(cur, name, kind, param, refreshed_until):
+    now = datetime.now()
+    if kind == 'active_days':
+        window_start = now - timedelta(days=int(param))
+        since = max(window_start, (refreshed_until or window_start) - SEGMENT_REFRESH_LAG)
+        cur.execute("""
+            INSERT INTO segment_members (segment, user_id, last_seen)
+            SELECT %s, user_id, MAX(last_open) FROM app_logs
+            WHERE last_open >= %s AND user_id IS NOT NULL GROUP BY user_id
+            ON CONFLICT (segment, user_id) DO UPDATE SET last_seen = GREATEST(segment_members.last_seen, EXCLUDED.last_seen)
+        """, (name, since))
+        cur.execute("DELETE FROM segment_members WHERE segment = %s AND last_seen < %s", (name, window_start))
+    else:
+        joined_after = datetime.fromisoformat(param)
+        since = max(joined_after, (refreshed_until or joined_after) - SEGMENT_REFRESH_LAG)
+        cur.execute("""
+            INSERT INTO segment_members (segment, user_id, last_seen)
+            SELECT %s, user_id, joined_at FROM users WHERE joined_at >= %s
+            ON CONFLICT (segment, user_id) DO NOTHING
+        """, (name, since))
+    cur.execute(
+        "UPDATE segments SET size = (SELECT COUNT(*) FROM segment_members WHERE segment = %s), "
+        "refreshed_until = %s, refreshed_at = CURRENT_TIMESTAMP WHERE name = %s",
+        (name, now, name)
+    )
+
+def refresh_segments(names=None, wait=False):
+    """সেগমেন্টগুলো (বা শুধু names) ইনক্রিমেন্টালি রিফ্রেশ করে; একাধিক ওয়ার্কারের মধ্যে একটিই চালায়।
+    পর্যায়ক্রমিক রিফ্রেশ অন্যটি চললে বাদ যায়; wait হলে (অ্যাডমিনের অনুরোধে) সেটি শেষ হওয়ার অপেক্ষা করে।
+    রিফ্রেশ হলে True"""
+    conn = get_db_connection()
+    if not conn: return False
+    try:
+        with conn.cursor() as cur:
+            if wait: locked = wait_advisory_lock(conn, cur, 'segment_refresh', 0.2, SEGMENT_REFRESH_WAIT)
+            else: locked = try_advisory_lock(cur, 'segment_refresh')
+            if not locked:
+                if wait: logger.warning(f"Segment refresh of {names} timed out waiting for another refresh")
+                return False
+            try:
+                cur.execute(
+                    "SELECT name, kind, param, refreshed_until FROM segments WHERE %s IS NULL OR name = ANY(%s) ORDER BY name",
+                    (names, names)
+                )
+                for name, kind, param, refreshed_until in cur.fetchall():
+                    _refresh_segment(cur, name, kind, param, refreshed_until)
+                    conn.commit()
+                return True
+            finally:
+                conn.rollback()
+                advisory_unlock(cur, 'segment_refresh')
+    except Exception as e:
+        logger.error(f"Segment Refresh Error: {e}")
+        return False
+    finally: release_db_connection(conn)
+
+def save_segment(name, kind, param):
+    """সেগমেন্ট তৈরি বা সংজ্ঞা বদলায়; আগের সদস্য মুছে যায় এবং পরের রিফ্রেশে নতুন করে হিসাব হয়"""
+    conn = get_db_connection()
+    if not conn: return False
+    try:
+        with conn.cursor() as cur:
+            cur.execute("""
+                INSERT INTO segments (name, kind, param) VALUES (%s, %s, %s)
+                ON CONFLICT (name) DO UPDATE SET kind = EXCLUDED.kind, param = EXCLUDED.param,
+                    size = 0, refreshed_until = NULL, refreshed_at = NULL
+            """, (name, kind, param))
+            cur.execute("DELETE FROM segment_members WHERE segment = %s", (name,))
+            conn.commit()
+            return True
+    finally: release_db_connection(conn)
+
+def delete_segment(name):
+    conn = get_db_connection()
+    if not conn: return False
+    try:
+        with conn.cursor() as cur:
+            cur.execute("DELETE FROM segments WHERE name = %s", (name,))
+            conn.commit()
+            return cur.rowcount > 0
+    finally: release_db_connection(conn)
+
+def fetch_segments():
+    conn = get_db_connection()
+    if not conn: return None
+    try:
+        with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
+            cur.execute("SELECT name, kind, param, size, refreshed_at FROM segments ORDER BY name")
+            return cur.fetchall()
+    finally: release_db_connection(conn)
+
+def count_broadcast_recipients(segment=None):
+    """ব্রডকাস্টের প্রাপক সংখ্যা; সেগমেন্ট না থাকলে -1"""
+    if not segment: return count_active_users()
+    conn = get_db_connection()
+    if not conn: return None
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT 1 FROM segments WHERE name = %s", (segment,))
+            if not cur.fetchone(): return -1
+            cur.execute(
+                "SELECT COUNT(*) FROM segment_members m JOIN users u ON u.user_id = m.user_id "
+                "WHERE m.segment = %s AND u.is_active IS NOT FALSE",
+                (segment,)
+            )
+            return cur.fetchone()[0]
+    finally: release_db_connection(conn)
+
+def fetch_statistics(days=STATS_DAYS):
+    """/statics এর সব সংখ্যা রোলআপ টেবিল থেকে একটি কুয়েরিতে ফেরত দেয়"""
+    conn = get_db_connection()
+    if not conn: return None
+    now = datetime.now()
+    try:
+        with conn.cursor() as cur:
+            cur.execute("""
+                SELECT
+                    (SELECT COALESCE(json_object_agg(name, value), '{}') FROM stats_counters),
+                    (SELECT COALESCE(json_object_agg(metric, total), '{}') FROM (
+                        SELECT metric, SUM(value) AS total FROM stats_hourly WHERE bucket >= %(last_24h)s GROUP BY metric
+                    ) h),
+                    (SELECT COALESCE(json_object_agg(metric, total), '{}') FROM (
+                        SELECT metric, SUM(value) AS total FROM stats_hourly WHERE bucket >= %(today)s GROUP BY metric
+                    ) t),
+                    (SELECT COALESCE(json_agg(d ORDER BY d.day DESC), '[]') FROM (
+                        SELECT bucket::date AS day,
+                               SUM(value) FILTER (WHERE metric = 'users') AS users,
+                               SUM(value) FILTER (WHERE metric = 'unique_opens') AS unique_opens,
+                               SUM(value) FILTER (WHERE metric = 'total_opens') AS total_opens
+                        FROM stats_hourly WHERE bucket >= %(since)s GROUP BY 1
+                    ) d)
+            """, {
+                # ঘণ্টার রেজোলিউশন: চলতি ঘণ্টা সহ শেষ ২৪টি বাকেট
+                'last_24h': now.replace(minute=0, second=0, microsecond=0) - timedelta(hours=23),
+                'today': now.replace(hour=0, minute=0, second=0, microsecond=0),
+                'since': now.replace(hour=0, minute=0, second=0, microsecond=0) - timedelta(days=days - 1),
+            })
+            lifetime, last_24h, today, daily = cur.fetchone()
+            return {
+                'total_users': lifetime.get('users', 0),
+                'today_users': today.get('users', 0),
+                'lifetime_unique_opens': lifetime.get('unique_opens', 0),
+                'today_unique_opens': last_24h.get('unique_opens', 0),
+                'lifetime_total_opens': lifetime.get('total_opens', 0),
+                'today_total_opens': last_24h.get('total_opens', 0),
+                'total_links': lifetime.get('links', 0),
+                'daily': daily,
+            }
+    finally: release_db_connection(conn)
+
+# --- স্থায়ী বট স্টেট (PTB persistence) ---
+# user_data ও কনভারসেশন স্টেট bot_state টেবিলে থাকে, তাই রিস্টার্টে অর্ধেক তৈরি বান্ডেল হারায় না।
+# PTB প্রতি PERSISTENCE_INTERVAL এ বদলানো এন্ট্রি দেয়; সেগুলো key অনুযায়ী একত্র হয়ে ব্যাচে লেখা হয়।
+# অ্যাডমিনের user_data ও কনভারসেশন স্টেট প্রতি আপডেটের আগে version মিলিয়ে রিফ্রেশ হয় এবং আপডেটের পরপরই
+# লেখা হয়, তাই কনভারসেশনের পরের ধাপ যেকোনো ওয়ার্কারে গেলেও সেটি সর্বশেষ স্টেট দেখে।
+PERSISTENCE_INTERVAL = float(os.getenv("PERSISTENCE_INTERVAL", 5))
+STATE_FLUSH_SIZE = int(os.getenv("STATE_FLUSH_SIZE", 500))
+STATE_FLUSH_INTERVAL = float(os.getenv("STATE_FLUSH_INTERVAL", 1))
+
+class PostgresPersistence(BasePersistence):
+    """bot_state (kind, key) -> JSONB; data None হলে রো মুছে যায়।
+    বাফারে data এর JSON স্ন্যাপশট যায়, লাইভ dict নয় (ফ্লাশ থ্রেড চলার সময় হ্যান্ডলার সেটি বদলাতে পারে)।"""
+
+    def __init__(self, update_interval):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, callback_data=False),
+            update_interval=update_interval,
+        )
+        # (kind, key) -> এই ওয়ার্কারের দেখা সর্বশেষ version
+        self._versions = {}
+        self.buffer = WriteBehindBuffer("BotState", self._flush, STATE_FLUSH_SIZE, STATE_FLUSH_INTERVAL, key=lambda row: row[:2])
+
+    def _load(self, kind):
+        conn = get_db_connection()
+        if not conn: return {}
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT key, data, version FROM bot_state WHERE kind = %s", (kind,))
+                rows = cur.fetchall()
+        finally: release_db_connection(conn)
+        for key, _, version in rows: self._versions[(kind, key)] = version
+        return {key: data for key, data, _ in rows}
+
+    def _fetch_newer(self, kind, key):
+        conn = get_db_connection()
+        if not conn: return None
+        try:
+            with conn.cursor() as cur:
+                cur.execute(
+                    "SELECT data, version FROM bot_state WHERE kind = %s AND key = %s AND version > %s",
+                    (kind, key, self._versions.get((kind, key), 0))
+                )
+                return cur.fetchone()
+        finally: release_db_connection(conn)
+
+    def _flush(self, rows):
+        conn = get_db_connection()
+        if not conn: return False
+        rows = sorted(rows, key=lambda row: row[:2])
+        deletes = [(kind, key) for kind, key, data in rows if data is None]
+        upserts = [row for row in rows if row[2] is not None]
+        try:
+            with conn.cursor() as cur:
+                if deletes:
+                    cur.execute(
+                        "DELETE FROM bot_state WHERE (kind, key) IN (SELECT * FROM unnest(%s::text[], %s::text[]))",
+                        ([kind for kind, _ in deletes], [key for _, key in deletes])
+                    )
+                versions = psycopg2.extras.execute_values(
+                    cur,
+                    "INSERT INTO bot_state (kind, key, data) VALUES %s ON CONFLICT (kind, key) DO UPDATE "
+                    "SET data = EXCLUDED.data, version = bot_state.version + 1, updated_at = CURRENT_TIMESTAMP "
+                    "RETURNING kind, key, version",
+                    upserts, template="(%s, %s, %s::jsonb)", fetch=True
+                ) if upserts else []
+                conn.commit()
+        finally: release_db_connection(conn)
+        for row in deletes: self._versions.pop(row, None)
+        for kind, key, version in versions: self._versions[(kind, key)] = version
+        return True
+
+    def _queue(self, kind, key, data):
+        # খালি dict মানে মুছে ফেলা; আগে কখনো লেখা না হলে কিছুই করার নেই (সাধারণ ইউজারদের জন্য লেখা এড়ায়)
+        if data == {}: data = None
+        if data is None and (kind, key) not in self._versions and (kind, key) not in self.buffer: return
+        self.buffer.add((kind, key, None if data is None else json.dumps(data)))
+
+    async def get_user_data(self):
+        return {int(key): data for key, data in (await run_db(self._load, 'user_data')).items()}
+
+    async def get_chat_data(self):
+        return {int(key): data for key, data in (await run_db(self._load, 'chat_data')).items()}
+
+    async def get_bot_data(self):
+        return (await run_db(self._load, 'bot_data')).get('', {})
+
+    async def get_callback_data(self):
+        data = (await run_db(self._load, 'callback_data')).get('')
+        return (data[0], data[1]) if data else None
+
+    async def get_conversations(self, name):
+        return {tuple(json.loads(key)): state for key, state in (await run_db(self._load, f'conversation:{name}')).items()}
+
+    async def update_conversation(self, name, key, new_state):
+        self._queue(f'conversation:{name}', json.dumps(list(key)), new_state)
+
+    async def update_user_data(self, user_id, data):
+        self._queue('user_data', str(user_id), data)
+
+    async def update_chat_data(self, chat_id, data):
+        self._queue('chat_data', str(chat_id), data)
+
+    async def update_bot_data(self, data):
+        self._queue('bot_data', '', data)
+
+    async def update_callback_data(self, data):
+        self._queue('callback_data', '', data)
+
+    async def drop_user_data(self, user_id):
+        self._queue('user_data', str(user_id), None)
+
+    async def drop_chat_data(self, chat_id):
+        self._queue('chat_data', str(chat_id), None)
+
+    async def refresh_user_data(self, user_id, user_data):
+        # শুধু অ্যাডমিনের স্টেট থাকে; সাধারণ ইউজারের আপডেটে বাড়তি কুয়েরি নয়।
+        # নিজের এখনো-না-লেখা পরিবর্তন থাকলে সেটিই নতুন
+        if user_id != ADMIN_USER_ID or ('user_data', str(user_id)) in self.buffer: return
+        row = await run_db(self._fetch_newer, 'user_data', str(user_id))
+        if row:
+            user_data.clear()
+            user_data.update(row[0])
+            self._versions[('user_data', str(user_id))] = row[1]
+
+    def _fetch_conversations(self, key):
+        conn = get_db_connection()
+        if not conn: return None
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT kind, data, version FROM bot_state WHERE kind LIKE 'conversation:%%' AND key = %s", (key,))
+                return {kind: (data, version) for kind, data, version in cur.fetchall()}
+        finally: release_db_connection(conn)
+
+    async def refresh_conversations(self, handlers, chat_id, user_id):
+        """অন্য ওয়ার্কারে বদলানো বা শেষ হওয়া কনভারসেশন স্টেট এখানকার হ্যান্ডলারে বসায়"""
+        key = json.dumps([chat_id, user_id])
+        rows = await run_db(self._fetch_conversations, key)
+        if rows is None: return
+        for handler in handlers:
+            kind = f'conversation:{handler.name}'
+            if (kind, key) in self.buffer: continue
+            row = rows.get(kind)
+            # PTB স্টেট বসানোর পাবলিক পথ দেয় না; ট্র্যাক ছাড়া বসানো হয়, যাতে একই স্টেট আবার লেখা না হয়
+            if row and row[1] > self._versions.get((kind, key), 0):
+                handler._conversations.update_no_track({(chat_id, user_id): row[0]})
+                self._versions[(kind, key)] = row[1]
+            elif not row and self._versions.pop((kind, key), None) is not None:
+                handler._conversations.data.pop((chat_id, user_id), None)
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+    async def flush(self):
+        await run_db(self.buffer.flush)
+
+bot_persistence = PostgresPersistence(PERSISTENCE_INTERVAL)
+QUEUE_DEPTH.labels('state').set_function(bot_persistence.buffer.__len__)
+
+def is_admin_update(update):
+    return bool(update.effective_user and update.effective_chat and update.effective_user.id == ADMIN_USER_ID)
+
+async def sync_admin_state(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """কনভারসেশন হ্যান্ডলারের আগে (group -1) অ্যাডমিনের কনভারসেশন স্টেট bot_state থেকে মেলায়"""
+    if not is_admin_update(update): return
+    handlers = [h for h in context.application.handlers.get(0, []) if isinstance(h, ConversationHandler) and h.persistent]
+    await bot_persistence.refresh_conversations(handlers, update.effective_chat.id, update.effective_user.id)
+
+async def persist_admin_state(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """হ্যান্ডলারের পরে (group 1) অ্যাডমিনের স্টেট PERSISTENCE_INTERVAL এর অপেক্ষা না করে সাথে সাথে লেখে"""
+    if not is_admin_update(update): return
+    await context.application.update_persistence()
+    await bot_persistence.flush()
 
 async def post_init(application: Application):
-    init_db()
+    global BOT_USERNAME
+    send_scheduler.start()
+    await run_db(settings_cache.load)
+    BOT_USERNAME = application.bot.username
+    # রিস্টার্টের আগে অসমাপ্ত বা অন্য ওয়ার্কারের ফেলে যাওয়া ব্রডকাস্ট চালু করা
+    start_background_task(watch_broadcast_jobs(application.bot), "broadcast-watch")
+    start_background_task(run_periodic(run_partition_maintenance, PARTITION_MAINTENANCE_INTERVAL, "Partition Maintenance", run_now=True), "partition-maintenance")
+    start_background_task(run_periodic(refresh_segments, SEGMENT_REFRESH_INTERVAL, "Segment Refresh"), "segment-refresh")
+    start_background_task(run_periodic(settings_cache.check_version, SETTINGS_VERSION_POLL, "Settings Refresh"), "settings-refresh")
     user_commands = [BotCommand("start", "বট শুরু করুন")]
     await application.bot.set_my_commands(user_commands)
     if ADMIN_USER_ID:
         admin_commands = [
             BotCommand("start", "বট শুরু করুন"),
-            BotCommand("alllink", "সব ফাইলের তালিকা"),
-            BotCommand("broadcast", "ব্রডকাস্ট"),
+            BotCommand("alllink", "ফাইলের তালিকা (/alllink শব্দ = খোঁজ)"),
+            BotCommand("broadcast", "ব্রডকাস্ট (/broadcast সেগমেন্ট)"),
+            BotCommand("segment", "অডিয়েন্স সেগমেন্ট"),
             BotCommand("statics", "পরিসংখ্যান"),
             BotCommand("setbtn", "বাটনের নাম পরিবর্তন"),
             BotCommand("seturl", "বাটনের লিঙ্ক পরিবর্তন"),
@@ -175,8 +1835,224 @@ async def post_init(application: Application):
             await application.bot.set_my_commands(admin_commands, scope=BotCommandScopeChat(chat_id=ADMIN_USER_ID))
         except Exception as e: logger.error(f"Menu Error: {e}")
 
+async def post_stop(application: Application):
+    await cancel_background_tasks()
+    await run_db(release_broadcast_jobs)
+    await send_scheduler.stop()
+
+# --- আউটবাউন্ড সেন্ড শিডিউলার ---
+# সব Bot API কল একটি প্রায়োরিটি কিউ দিয়ে যায়: গ্লোবাল রেট (SEND_GLOBAL_RATE/সেকেন্ড), চ্যাট-প্রতি টোকেন বাকেট
+# (SEND_CHAT_RATE, SEND_CHAT_BURST) এবং RetryAfter এ সবার জন্য বিরতি। অলস ওয়ার্কার টোকেন ধরে রাখে না (আগে আইটেম,
+# তারপর টোকেন), তাই অলস সময়ের পরেও যেকোনো এক সেকেন্ডে SEND_GLOBAL_RATE + SEND_GLOBAL_BURST এর বেশি কল যায় না।
+# টোকেন পাওয়ার পর কিউতে বেশি জরুরি আইটেম থাকলে সেটি আগে যায়, তাই ইন্টারঅ্যাক্টিভ ডেলিভারি ব্রডকাস্টের আগে যায়।
+PRIORITY_INTERACTIVE, PRIORITY_ADMIN, PRIORITY_BULK = 0, 1, 2
+SEND_GLOBAL_RATE = float(os.getenv("SEND_GLOBAL_RATE", 28))
+SEND_GLOBAL_BURST = int(os.getenv("SEND_GLOBAL_BURST", 1))
+SEND_CHAT_RATE = float(os.getenv("SEND_CHAT_RATE", 1))
+SEND_CHAT_BURST = int(os.getenv("SEND_CHAT_BURST", 5))
+SEND_WORKERS = int(os.getenv("SEND_WORKERS", 16))
+SEND_RETRIES = int(os.getenv("SEND_RETRIES", 3))
+
+def retry_after_seconds(error):
+    retry_after = error.retry_after
+    return retry_after.total_seconds() if isinstance(retry_after, timedelta) else float(retry_after)
+
+class RateLimiter:
+    """টোকেন বাকেট রেট লিমিটার; RetryAfter পেলে সবার জন্য পজ করে"""
+
+    def __init__(self, rate, burst=1):
+        self.rate, self.burst = rate, burst
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def pause(self, seconds):
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    def refund(self):
+        """নেওয়া টোকেন ব্যবহার না হলে ফেরত দেয়"""
+        self._tokens = min(self.burst, self._tokens + 1)
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+class SendScheduler:
+    """প্রায়োরিটি, রেট লিমিট ও RetryAfter ব্যাকঅফ সহ কেন্দ্রীয় আউটবাউন্ড কিউ"""
+
+    def __init__(self, global_rate, global_burst, chat_rate, chat_burst, workers, max_retries):
+        self.chat_rate, self.chat_burst, self.workers, self.max_retries = chat_rate, chat_burst, workers, max_retries
+        self._global = RateLimiter(global_rate, burst=max(1, global_burst))
+        self._chats = {}
+        self._queue = asyncio.PriorityQueue()
+        self._seq = itertools.count()
+        self._tasks = []
+
+    def qsize(self):
+        return self._queue.qsize()
+
+    def start(self):
+        if not self._tasks:
+            loop = asyncio.get_running_loop()
+            self._tasks = [loop.create_task(self._worker(), name=f"send-worker-{i}") for i in range(self.workers)]
+
+    async def stop(self):
+        for task in self._tasks: task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        while not self._queue.empty():
+            future = self._queue.get_nowait()[4]
+            if not future.done(): future.cancel()
+
+    async def send(self, priority, chat_id, func, /, *args, **kwargs):
+        """func(*args, **kwargs) কিউয়ের মাধ্যমে চালায় এবং এর ফলাফল ফেরত দেয়; chat_id None হলে চ্যাট লিমিট নেই"""
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((priority, next(self._seq), chat_id, functools.partial(func, *args, **kwargs), future, 0))
+        return await future
+
+    def _chat_delay(self, chat_id):
+        """চ্যাটের টোকেন থাকলে একটি নেয় এবং 0 ফেরত দেয়, না থাকলে কত সেকেন্ড পর পাওয়া যাবে"""
+        if chat_id is None: return 0
+        now = time.monotonic()
+        tokens, updated = self._chats.get(chat_id, (self.chat_burst, now))
+        tokens = min(self.chat_burst, tokens + (now - updated) * self.chat_rate)
+        if tokens < 1:
+            self._chats[chat_id] = (tokens, now)
+            return (1 - tokens) / self.chat_rate
+        self._chats[chat_id] = (tokens - 1, now)
+        if len(self._chats) > 50000:
+            # পূর্ণ বাকেটের চ্যাট বাদ দিয়ে মেমরি সীমিত রাখা
+            idle = now - self.chat_burst / self.chat_rate
+            self._chats = {c: v for c, v in self._chats.items() if v[1] > idle}
+        return 0
+
+    async def _worker(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            item = await self._queue.get()
+            await self._global.acquire()
+            # টোকেনের অপেক্ষার মধ্যে বেশি জরুরি আইটেম এলে সেটি নেওয়া (হিপ সবচেয়ে জরুরিটি দেয়)
+            if not self._queue.empty():
+                self._queue.put_nowait(item)
+                item = self._queue.get_nowait()
+            priority, seq, chat_id, call, future, attempt = item
+            if future.done():
+                self._global.refund()
+                continue
+            delay = self._chat_delay(chat_id)
+            if delay > 0:
+                self._global.refund()
+                loop.call_later(delay, self._queue.put_nowait, item)
+                continue
+            method = getattr(call.func, '__name__', 'unknown')
+            started = time.perf_counter()
+            try:
+                result = await call()
+            except RetryAfter as e:
+                BOT_API_RETRY_AFTER.labels(method).inc()
+                BOT_API_CALLS.labels(method, 'retry_after').inc()
+                self._global.pause(retry_after_seconds(e))
+                if attempt < self.max_retries:
+                    self._queue.put_nowait((priority, seq, chat_id, call, future, attempt + 1))
+                elif not future.done(): future.set_exception(e)
+            except Exception as e:
+                BOT_API_CALLS.labels(method, 'error').inc()
+                if not future.done(): future.set_exception(e)
+            else:
+                BOT_API_CALLS.labels(method, 'ok').inc()
+                if not future.done(): future.set_result(result)
+            finally:
+                BOT_API_SECONDS.labels(method).observe(time.perf_counter() - started)
+
+send_scheduler = SendScheduler(SEND_GLOBAL_RATE, SEND_GLOBAL_BURST, SEND_CHAT_RATE, SEND_CHAT_BURST, SEND_WORKERS, SEND_RETRIES)
+QUEUE_DEPTH.labels('send').set_function(send_scheduler.qsize)
+
+async def tg_send(priority, chat_id, func, /, *args, **kwargs):
+    return await send_scheduler.send(priority, chat_id, func, *args, **kwargs)
+
+# টেলিগ্রাম মেসেজের সর্বোচ্চ দৈর্ঘ্য (UTF-16 ইউনিটে)
+TELEGRAM_TEXT_LIMIT = 4096
+
+def split_message(text, limit=TELEGRAM_TEXT_LIMIT):
+    """লম্বা টেক্সট লাইনের সীমানায় limit এর মধ্যে কয়েকটি অংশে ভাগ করে"""
+    chunks, current, size = [], "", 0
+    for line in text.splitlines(keepends=True):
+        line_size = len(line.encode('utf-16-le')) // 2
+        if current and size + line_size > limit:
+            chunks.append(current)
+            current, size = "", 0
+        current += line
+        size += line_size
+    if current: chunks.append(current)
+    return chunks
+
+async def reply(update, text, priority=PRIORITY_ADMIN, **kwargs):
+    """update এর চ্যাটে শিডিউলারের মাধ্যমে রিপ্লাই পাঠায়"""
+    return await tg_send(priority, update.effective_chat.id, update.effective_message.reply_text, text, **kwargs)
+
+# --- কন্টেন্ট ডেলিভারি ---
+MEDIA_GROUP_LIMIT = 10
+# পরপর একই গ্রুপের আইটেম একটি অ্যালবামে যায় (ছবি ও ভিডিও একসাথে মেশানো যায়)
+MEDIA_GROUP_KIND = {'photo': 'visual', 'video': 'visual', 'document': 'document', 'audio': 'audio'}
+INPUT_MEDIA = {'photo': InputMediaPhoto, 'video': InputMediaVideo, 'document': InputMediaDocument, 'audio': InputMediaAudio}
+# ধরন -> (Bot মেথড, আর্গুমেন্টের নাম)
+SEND_METHOD = {
+    'text': ('send_message', 'text'),
+    'video': ('send_video', 'video'),
+    'document': ('send_document', 'document'),
+    'audio': ('send_audio', 'audio'),
+    'photo': ('send_photo', 'photo'),
+}
+
+def plan_delivery(items):
+    """[(kind, [(type, value)])] - পরপর একই ধরনের মিডিয়া ১০টি পর্যন্ত একসাথে"""
+    chunks = []
+    for ftype, value in items:
+        kind = MEDIA_GROUP_KIND.get(ftype)
+        if kind and chunks and chunks[-1][0] == kind and len(chunks[-1][1]) < MEDIA_GROUP_LIMIT:
+            chunks[-1][1].append((ftype, value))
+        else:
+            chunks.append((kind, [(ftype, value)]))
+    return chunks
+
+async def _send_single(bot, chat_id, ftype, value):
+    if ftype not in SEND_METHOD: return
+    method, arg = SEND_METHOD[ftype]
+    await tg_send(PRIORITY_INTERACTIVE, chat_id, getattr(bot, method), chat_id=chat_id, protect_content=True, **{arg: value})
+
+async def deliver_bundle(bot, chat_id, items):
+    """বান্ডেলের আইটেম অ্যালবাম আকারে পাঠায়; যেগুলো পাঠানো যায়নি তাদের সংখ্যা ফেরত দেয়"""
+    failed = 0
+    for kind, chunk in plan_delivery(items):
+        if len(chunk) > 1:
+            media = [INPUT_MEDIA[ftype](value) for ftype, value in chunk]
+            try:
+                await tg_send(PRIORITY_INTERACTIVE, chat_id, bot.send_media_group, chat_id=chat_id, media=media, protect_content=True)
+                continue
+            except Exception as e:
+                # একটি খারাপ file_id পুরো অ্যালবাম আটকে দেয়, তাই আলাদা করে পাঠানো
+                logger.warning(f"Media group to {chat_id} failed, sending items one by one: {e}")
+        for ftype, value in chunk:
+            try: await _send_single(bot, chat_id, ftype, value)
+            except Exception as e:
+                failed += 1
+                logger.error(f"Delivery Error ({ftype} to {chat_id}): {e}")
+    return failed
+
 # --- বট হ্যান্ডলারসমূহ ---
 
+@timed_handler
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user = update.effective_user
     if user:
@@ -184,167 +2060,352 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     
     if context.args:
         file_code = context.args[0]
-        conn = get_db_connection()
-        if not conn: return
-        try:
-            with conn.cursor() as cur:
-                cur.execute("SELECT file_type, file_id, title FROM files WHERE custom_code = %s", (file_code,))
-                res = cur.fetchone()
-            if res:
-                f_types, f_ids, title = res
-                await context.bot.send_message(chat_id=user.id, text=f"*{title}*", parse_mode='Markdown')
-                ids_list = f_ids.split('|')
-                types_list = f_types.split('|')
-                for fid, ftype in zip(ids_list, types_list):
-                    try:
-                        if ftype == 'text': await context.bot.send_message(chat_id=user.id, text=fid, protect_content=True)
-                        elif ftype == 'video': await context.bot.send_video(chat_id=user.id, video=fid, protect_content=True)
-                        elif ftype == 'document': await context.bot.send_document(chat_id=user.id, document=fid, protect_content=True)
-                        elif ftype == 'audio': await context.bot.send_audio(chat_id=user.id, audio=fid, protect_content=True)
-                        elif ftype == 'photo': await context.bot.send_photo(chat_id=user.id, photo=fid, protect_content=True)
-                        await asyncio.sleep(0.3)
-                    except: continue
-        finally: conn.close()
+        bundle = await load_bundle(file_code)
+        if bundle:
+            await tg_send(PRIORITY_INTERACTIVE, user.id, context.bot.send_message, chat_id=user.id, text=f"*{bundle['title']}*", parse_mode='Markdown')
+            failed = await deliver_bundle(context.bot, user.id, bundle['items'])
+            if failed:
+                logger.error(f"{failed} item(s) of '{file_code}' could not be delivered to {user.id}")
+                await tg_send(PRIORITY_INTERACTIVE, user.id, context.bot.send_message, chat_id=user.id, text=f"⚠️ {failed}টি কন্টেন্ট পাঠানো যায়নি। কিছুক্ষণ পর আবার চেষ্টা করুন।")
     else:
-        await update.message.reply_text(f"স্বাগতম {user.first_name}😎 এই বটে আপনি নিয়মিত নতুন লিংকের আপডেট পাবেন।")
+        await reply(update, f"স্বাগতম {user.first_name}😎 এই বটে আপনি নিয়মিত নতুন লিংকের আপডেট পাবেন।", PRIORITY_INTERACTIVE)
 
 # --- সেটিং পরিবর্তন কনভারসেশন ---
 
 async def set_btn_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     if update.effective_user.id != ADMIN_USER_ID: return ConversationHandler.END
-    await update.message.reply_text("✍️ চ্যানেলের বাটনের জন্য একটি **নাম** দিন:")
+    await reply(update, "✍️ চ্যানেলের বাটনের জন্য একটি **নাম** দিন:")
     return SET_BTN_NAME
 
 async def save_btn_name(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     new_name = update.message.text.strip()
-    set_setting("channel_btn_name", new_name)
-    await update.message.reply_text(f"✅ বাটনের নাম সেট হয়েছে: **{new_name}**")
+    await run_db(set_setting, "channel_btn_name", new_name)
+    await reply(update, f"✅ বাটনের নাম সেট হয়েছে: **{new_name}**")
     return ConversationHandler.END
 
 async def set_url_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     if update.effective_user.id != ADMIN_USER_ID: return ConversationHandler.END
-    await update.message.reply_text("🔗 বাটনের জন্য নতুন **লিঙ্ক** দিন (অটো মিনি অ্যাপের জন্য লিখুন `bot`):")
+    await reply(update, "🔗 বাটনের জন্য নতুন **লিঙ্ক** দিন (অটো মিনি অ্যাপের জন্য লিখুন `bot`):")
     return SET_BTN_URL
 
 async def save_btn_url(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     new_url = update.message.text.strip().lower()
     if new_url != "bot" and not new_url.startswith("http"):
-        await update.message.reply_text("❌ সঠিক লিঙ্ক দিন অথবা `bot` লিখুন।")
+        await reply(update, "❌ সঠিক লিঙ্ক দিন অথবা `bot` লিখুন।")
         return SET_BTN_URL
-    set_setting("channel_btn_url", new_url)
-    await update.message.reply_text(f"✅ বাটনের লিঙ্ক সেট হয়েছে।")
+    await run_db(set_setting, "channel_btn_url", new_url)
+    await reply(update, f"✅ বাটনের লিঙ্ক সেট হয়েছে।")
     return ConversationHandler.END
 
+@timed_handler
 async def statics_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     if update.effective_user.id != ADMIN_USER_ID: return
-    conn = get_db_connection()
-    if not conn: return
-    try:
-        with conn.cursor() as cur:
-            # ইউজার রিপোর্ট
-            cur.execute("SELECT COUNT(*) FROM users")
-            total_users = cur.fetchone()[0]
-            cur.execute("SELECT COUNT(*) FROM users WHERE joined_at >= CURRENT_DATE")
-            today_users = cur.fetchone()[0]
-            
-            # অ্যাপ ইউনিক রিপোর্ট (২৪ ঘণ্টা ও লাইফটাইম)
-            cur.execute("SELECT COUNT(*) FROM app_logs")
-            lifetime_unique_opens = cur.fetchone()[0]
-            cur.execute("SELECT COUNT(*) FROM app_logs WHERE last_open >= (NOW() - INTERVAL '24 HOURS')")
-            today_unique_opens = cur.fetchone()[0]
-            
-            # অ্যাপ টোটাল রিপোর্ট (২৪ ঘণ্টা ও লাইফটাইম)
-            cur.execute("SELECT COUNT(*) FROM app_hits")
-            lifetime_total_opens = cur.fetchone()[0]
-            cur.execute("SELECT COUNT(*) FROM app_hits WHERE hit_time >= (NOW() - INTERVAL '24 HOURS')")
-            today_total_opens = cur.fetchone()[0]
-            
-            # লিঙ্ক রিপোর্ট
-            cur.execute("SELECT COUNT(*) FROM files")
-            total_links = cur.fetchone()[0]
-            
-            stats_msg = (
-                "📊 **বট ব্যবহারের পরিসংখ্যান**\n"
-                "━━━━━━━━━━━━━━━━━━━━\n"
-                f"👤 **ইউজার রিপোর্ট**\n"
-                f"├ আজকের নতুন: `{today_users}`\n"
-                f"└ মোট ইউজার: `{total_users}`\n\n"
-                f"📱 **মিনি অ্যাপ রিপোর্ট**\n"
-                f"├ গত ২৪ ঘণ্টায় (ইউনিক): `{today_unique_opens}`\n"
-                f"├ গত ২৪ ঘণ্টায় (টোটাল): `{today_total_opens}`\n"
-                f"├ মোট ওপেন (ইউনিক): `{lifetime_unique_opens}`\n"
-                f"└ মোট ওপেন (টোটাল): `{lifetime_total_opens}`\n\n"
-                f"🔗 **লিঙ্ক রিপোর্ট**\n"
-                f"└ মোট তৈরি লিঙ্ক: `{total_links}`\n"
-                "━━━━━━━━━━━━━━━━━━━━\n"
-                f"📅 তারিখ: {datetime.now().strftime('%d %B, %Y')}"
-            )
-            await update.message.reply_text(stats_msg, parse_mode='Markdown')
-    finally: conn.close()
+    # /statics 30 -> শেষ ৩০ দিনের দৈনিক হিসাব
+    days = int(context.args[0]) if context.args and context.args[0].isdigit() else STATS_DAYS
+    days = max(1, min(days, 90))
+    stats = await run_db(fetch_statistics, days)
+    if not stats: return
+    daily_lines = "".join(
+        f"├ {datetime.strptime(d['day'], '%Y-%m-%d').strftime('%d/%m')}: "
+        f"👤 `{d['users'] or 0}` | 📱 `{d['unique_opens'] or 0}` / `{d['total_opens'] or 0}`\n"
+        for d in stats['daily']
+    ) or "└ কোনো ডেটা নেই\n"
+    stats_msg = (
+        "📊 **বট ব্যবহারের পরিসংখ্যান**\n"
+        "━━━━━━━━━━━━━━━━━━━━\n"
+        f"👤 **ইউজার রিপোর্ট**\n"
+        f"├ আজকের নতুন: `{stats['today_users']}`\n"
+        f"└ মোট ইউজার: `{stats['total_users']}`\n\n"
+        f"📱 **মিনি অ্যাপ রিপোর্ট**\n"
+        f"├ গত ২৪ ঘণ্টায় (ইউনিক): `{stats['today_unique_opens']}`\n"
+        f"├ গত ২৪ ঘণ্টায় (টোটাল): `{stats['today_total_opens']}`\n"
+        f"├ মোট ওপেন (ইউনিক): `{stats['lifetime_unique_opens']}`\n"
+        f"└ মোট ওপেন (টোটাল): `{stats['lifetime_total_opens']}`\n\n"
+        f"🔗 **লিঙ্ক রিপোর্ট**\n"
+        f"└ মোট তৈরি লিঙ্ক: `{stats['total_links']}`\n\n"
+        f"📆 **দৈনিক হিসাব (শেষ {days} দিন)**\n"
+        f"{daily_lines}"
+        "━━━━━━━━━━━━━━━━━━━━\n"
+        f"📅 তারিখ: {datetime.now().strftime('%d %B, %Y')}"
+    )
+    # ৯০ দিনের দৈনিক হিসাব একটি মেসেজের সীমা ছাড়াতে পারে
+    for chunk in split_message(stats_msg):
+        await reply(update, chunk, parse_mode='Markdown')
 
 # --- ব্রডকাস্ট লজিক ---
 
+SEGMENT_USAGE = (
+    "ব্যবহার:\n"
+    f"`/segment নাম active_days 7` - শেষ ৭ দিনে মিনি অ্যাপ খুলেছে (সর্বোচ্চ {SEGMENT_MAX_DAYS} দিন)\n"
+    "`/segment নাম joined_after 2024-01-31` - এই তারিখ থেকে যোগ দিয়েছে\n"
+    "`/segment নাম delete` - মুছে ফেলা\n"
+    "`/broadcast নাম` - শুধু এই সেগমেন্টে ব্রডকাস্ট"
+)
+
+SEGMENT_STALE_NOTE = "\n⚠️ সেগমেন্ট এখন রিফ্রেশ করা যায়নি, সংখ্যা পুরোনো হতে পারে।"
+
+def describe_segment(kind, param):
+    return f"শেষ {param} দিনে সক্রিয়" if kind == 'active_days' else f"{param} থেকে যোগ দিয়েছে"
+
+@timed_handler
+async def segment_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if update.effective_user.id != ADMIN_USER_ID: return
+    args = context.args
+    if not args:
+        segments = await run_db(fetch_segments)
+        if segments is None: return
+        lines = "".join(
+            f"├ `{s['name']}`: {describe_segment(s['kind'], s['param'])} - `{s['size']}` জন\n" for s in segments
+        ) or "└ কোনো সেগমেন্ট নেই\n"
+        await reply(update, f"🎯 **অডিয়েন্স সেগমেন্ট**\n{lines}\n{SEGMENT_USAGE}", parse_mode='Markdown')
+        return
+    name = args[0].lower()
+    if not SEGMENT_NAME.match(name):
+        await reply(update, "❌ নামে শুধু a-z, 0-9 ও _ (৩২ অক্ষর পর্যন্ত)।")
+        return
+    if len(args) == 2 and args[1] == 'delete':
+        deleted = await run_db(delete_segment, name)
+        await reply(update, "🗑 সেগমেন্ট মুছে ফেলা হয়েছে।" if deleted else "❌ সেগমেন্ট পাওয়া যায়নি।")
+        return
+    param = parse_segment_param(args[1], args[2]) if len(args) == 3 and args[1] in SEGMENT_KINDS else None
+    if param is None:
+        await reply(update, SEGMENT_USAGE, parse_mode='Markdown')
+        return
+    if not await run_db(save_segment, name, args[1], param): return
+    refreshed = await run_db(refresh_segments, [name], True)
+    size = await run_db(count_broadcast_recipients, name)
+    await reply(
+        update,
+        f"✅ সেগমেন্ট `{name}` ({describe_segment(args[1], param)}): `{size}` জন" + ("" if refreshed else SEGMENT_STALE_NOTE),
+        parse_mode='Markdown'
+    )
+
+@timed_handler
 async def broadcast_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     if update.effective_user.id != ADMIN_USER_ID: return ConversationHandler.END
-    await update.message.reply_text("📢 **ব্রডকাস্ট শুরু করুন**\n\nমেসেজ বা মিডিয়া পাঠান।", parse_mode='Markdown')
+    # /broadcast <সেগমেন্ট> -> শুধু সেই সেগমেন্টের সদস্যরা; পাঠানোর আগে প্রাপক সংখ্যা দেখানো হয়
+    segment = context.args[0].lower() if context.args else None
+    refreshed = await run_db(refresh_segments, [segment], True) if segment else True
+    total = await run_db(count_broadcast_recipients, segment)
+    if total is None: return ConversationHandler.END
+    if total < 0:
+        await reply(update, f"❌ সেগমেন্ট `{segment}` পাওয়া যায়নি। /segment দেখুন।", parse_mode='Markdown')
+        return ConversationHandler.END
+    context.user_data['broadcast_segment'] = segment
+    audience = f"সেগমেন্ট `{segment}`" if segment else "সব ইউজার"
+    await reply(
+        update,
+        f"📢 **ব্রডকাস্ট শুরু করুন**\n\n🎯 প্রাপক: {audience} - `{total}` জন"
+        f"{'' if refreshed else SEGMENT_STALE_NOTE}\n\nমেসেজ বা মিডিয়া পাঠান।",
+        parse_mode='Markdown'
+    )
     return GET_BROADCAST_MSG
 
+@timed_handler
 async def send_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     admin_msg = update.message
-    conn = get_db_connection()
-    if not conn: return ConversationHandler.END
-    try:
-        with conn.cursor() as cur:
-            cur.execute("SELECT user_id FROM users")
-            users = cur.fetchall()
-        total = len(users)
-        progress_msg = await update.message.reply_text(f"⏳ ব্রডকাস্টিং শুরু... (০/{total})")
-        success = 0
-        for index, (u_id,) in enumerate(users, 1):
-            try:
-                await context.bot.copy_message(chat_id=u_id, from_chat_id=admin_msg.chat_id, message_id=admin_msg.message_id, protect_content=True)
-                success += 1
-            except: continue
-            if index % 10 == 0: await progress_msg.edit_text(f"⏳ ব্রডকাস্টিং চলছে... ({index}/{total})")
-            await asyncio.sleep(0.05)
-        await progress_msg.edit_text(f"✅ সম্পন্ন! সফল: `{success}`")
-    finally: conn.close()
+    segment = context.user_data.pop('broadcast_segment', None)
+    total = await run_db(count_broadcast_recipients, segment)
+    if total is None or total < 0: return ConversationHandler.END
+    progress_msg = await reply(update, f"⏳ ব্রডকাস্টিং শুরু... (০/{total})")
+    job = await run_db(
+        create_broadcast_job, admin_msg.chat_id, admin_msg.message_id, total, progress_msg.chat_id, progress_msg.message_id, segment
+    )
+    if job: start_broadcast_job(context.bot, job)
     return ConversationHandler.END
 
+# ব্রডকাস্ট সেটিংস: রেট লিমিট ও RetryAfter শিডিউলার সামলায়; BROADCAST_CONCURRENCY কিউতে একসাথে কতগুলো
+# বাল্ক মেসেজ থাকতে পারে তা সীমিত রাখে
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", 20))
+BROADCAST_BATCH_SIZE = int(os.getenv("BROADCAST_BATCH_SIZE", 500))
+BROADCAST_PROGRESS_INTERVAL = float(os.getenv("BROADCAST_PROGRESS_INTERVAL", 5))
+BROADCAST_MAX_RETRIES = int(os.getenv("BROADCAST_MAX_RETRIES", 3))
+
+async def _broadcast_copy(bot, job, user_id):
+    """একজন ইউজারকে মেসেজ কপি করে; ফলাফল 'sent', 'blocked' বা 'failed'"""
+    for attempt in range(BROADCAST_MAX_RETRIES + 1):
+        try:
+            await tg_send(
+                PRIORITY_BULK, user_id, bot.copy_message,
+                chat_id=user_id, from_chat_id=job['from_chat_id'], message_id=job['message_id'], protect_content=True
+            )
+            return 'sent'
+        except RetryAfter as e:
+            logger.warning(f"Broadcast to {user_id} gave up after repeated flood control: {e}")
+            return 'failed'
+        except Forbidden:
+            return 'blocked'
+        except BadRequest as e:
+            if 'chat not found' in str(e).lower(): return 'blocked'
+            logger.warning(f"Broadcast to {user_id} failed: {e}")
+            return 'failed'
+        except Exception as e:
+            logger.warning(f"Broadcast to {user_id} failed (attempt {attempt + 1}): {e}")
+            await asyncio.sleep(1)
+    return 'failed'
+
+async def _edit_broadcast_progress(bot, job, text):
+    if not job.get('progress_chat_id'): return
+    try:
+        await tg_send(
+            PRIORITY_ADMIN, job['progress_chat_id'], bot.edit_message_text,
+            text, chat_id=job['progress_chat_id'], message_id=job['progress_message_id'], parse_mode='Markdown'
+        )
+    except Exception as e: logger.warning(f"Broadcast Progress Error: {e}")
+
+def start_broadcast_job(bot, job):
+    name = f"broadcast-{job['job_id']}"
+    if any(task.get_name() == name for task in _background_tasks): return
+    start_background_task(run_broadcast_job(bot, job), name)
+
+async def watch_broadcast_jobs(bot):
+    """পর্যায়ক্রমে অন্য (বা আগের) ওয়ার্কারের ফেলে যাওয়া ব্রডকাস্ট জব দাবি করে চালায়"""
+    while True:
+        try:
+            for job in await run_db(claim_broadcast_jobs):
+                logger.info(f"Claimed broadcast job {job['job_id']} after user {job['last_user_id']}")
+                start_broadcast_job(bot, job)
+        except Exception as e: logger.error(f"Broadcast Claim Error: {e}")
+        await asyncio.sleep(BROADCAST_CLAIM_INTERVAL)
+
+async def run_broadcast_job(bot, job):
+    """ব্যাকগ্রাউন্ড ব্রডকাস্ট: ব্যাচে প্রাপক আনে, সীমিত কনকারেন্সিতে পাঠায় এবং প্রতি ব্যাচে চেকপয়েন্ট করে"""
+    job_id, total = job['job_id'], job['total']
+    last_user_id = job['last_user_id']
+    counts = {'sent': job['sent'], 'failed': job['failed'], 'blocked': job['blocked']}
+    semaphore = asyncio.Semaphore(BROADCAST_CONCURRENCY)
+    last_progress = time.monotonic()
+    lease_lost = asyncio.Event()
+
+    async def heartbeat():
+        while True:
+            await asyncio.sleep(BROADCAST_LEASE_SECONDS / 3)
+            if await run_db(renew_broadcast_lease, job_id) is False:
+                lease_lost.set()
+                return
+
+    async def deliver(user_id):
+        async with semaphore:
+            # লিজ হারালে বাকিদের অন্য ওয়ার্কার পাঠাবে
+            if lease_lost.is_set(): return user_id, None
+            result = await _broadcast_copy(bot, job, user_id)
+        counts[result] += 1
+        return user_id, result
+
+    heartbeat_task = asyncio.get_running_loop().create_task(heartbeat(), name=f"broadcast-{job_id}-lease")
+    try:
+        while True:
+            batch = await run_db(fetch_broadcast_recipients, last_user_id, BROADCAST_BATCH_SIZE, job.get('segment'))
+            if batch is None:
+                logger.error(f"Broadcast job {job_id} paused: database unavailable")
+                return
+            if not batch: break
+            results = await asyncio.gather(*(deliver(u_id) for u_id in batch))
+            if lease_lost.is_set():
+                logger.warning(f"Broadcast job {job_id} lease lost mid-batch, stopping on this worker")
+                return
+            blocked = [u_id for u_id, result in results if result == 'blocked']
+            # পরে /start দিলে যেন আবার সক্রিয় হিসেবে লেখা হয়
+            for u_id in blocked: user_seen_cache.pop(u_id)
+            last_user_id = batch[-1]
+            if await run_db(checkpoint_broadcast_job, job_id, last_user_id, counts, 'running', blocked) is False:
+                logger.warning(f"Broadcast job {job_id} lease lost, stopping on this worker")
+                return
+            if time.monotonic() - last_progress >= BROADCAST_PROGRESS_INTERVAL:
+                last_progress = time.monotonic()
+                done = sum(counts.values())
+                await _edit_broadcast_progress(bot, job, f"⏳ ব্রডকাস্টিং চলছে... ({done}/{total})")
+        await run_db(checkpoint_broadcast_job, job_id, last_user_id, counts, 'done')
+        await _edit_broadcast_progress(
+            bot, job, f"✅ সম্পন্ন! সফল: `{counts['sent']}` | ব্লকড: `{counts['blocked']}` | ব্যর্থ: `{counts['failed']}`"
+        )
+    except Exception as e:
+        logger.error(f"Broadcast job {job_id} Error: {e}")
+    finally:
+        heartbeat_task.cancel()
+
+# পেজিং স্টেট user_data['links'] এ থাকে; callback_data তে শুধু ছোট অ্যাকশন (৬৪ বাইট সীমা)
+async def render_links_page(state, cursor=None, backward=False):
+    page = await run_db(fetch_links_page, state['sort'], state['search'], cursor, backward)
+    if page is None: return None, None
+    rows, more = page
+    # পুরোনো বাটন থেকে কিনারার বাইরে গেলে মেসেজ যেমন আছে থাকুক
+    if not rows and cursor is not None: return None, None
+    if not rows:
+        text = "🔍 কোনো লিঙ্ক পাওয়া যায়নি।" if state['search'] else "📂 কোনো লিঙ্ক নেই।"
+        return text, None
+    if backward:
+        state['page'] -= 1
+        has_prev, has_next = more, True
+    else:
+        state['page'] += 1
+        has_prev, has_next = cursor is not None, more
+    state['first'], state['last'] = [rows[0][2], rows[0][0]], [rows[-1][2], rows[-1][0]]
+    keyboard = [[InlineKeyboardButton(t or c, callback_data=c)] for c, t, _ in rows]
+    nav = []
+    if has_prev: nav.append(InlineKeyboardButton("◀️ আগে", callback_data="links:prev"))
+    if has_next: nav.append(InlineKeyboardButton("পরে ▶️", callback_data="links:next"))
+    if nav: keyboard.append(nav)
+    keyboard.append([InlineKeyboardButton(
+        "🔤 নাম অনুযায়ী সাজান" if state['sort'] == 'new' else "🕒 নতুন আগে সাজান", callback_data="links:sort"
+    )])
+    search = state['search'].replace('`', "'") if state['search'] else None
+    text = (
+        f"📂 **{'খোঁজ: `' + search + '`' if search else 'সব লিঙ্ক'}**\n"
+        f"সাজানো: {'নতুন আগে' if state['sort'] == 'new' else 'নাম অনুযায়ী'} | পৃষ্ঠা {state['page']}"
+    )
+    return text, InlineKeyboardMarkup(keyboard)
+
+@timed_handler
 async def all_links(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     if update.effective_user.id != ADMIN_USER_ID: return
-    conn = get_db_connection()
-    if not conn: return
-    try:
-        with conn.cursor() as cur:
-            cur.execute("SELECT custom_code, title FROM files")
-            results = cur.fetchall()
-        if results:
-            keyboard = [[InlineKeyboardButton(t or c, callback_data=c)] for c, t in results]
-            await update.message.reply_text('📂 **সব লিঙ্ক:**', reply_markup=InlineKeyboardMarkup(keyboard), parse_mode='Markdown')
-    finally: conn.close()
+    # /alllink <শব্দ> -> শিরোনাম বা কোড দিয়ে খোঁজ
+    state = {'sort': 'new', 'search': " ".join(context.args).strip() or None, 'page': 0}
+    context.user_data['links'] = state
+    text, markup = await render_links_page(state)
+    if text:
+        await reply(update, text, reply_markup=markup, parse_mode='Markdown')
+
+@timed_handler
+async def links_page_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    query = update.callback_query
+    if update.effective_user.id != ADMIN_USER_ID: return
+    state = context.user_data.get('links')
+    if not state:
+        await tg_send(PRIORITY_ADMIN, None, query.answer, "⌛ তালিকার মেয়াদ শেষ, আবার /alllink দিন।")
+        return
+    await tg_send(PRIORITY_ADMIN, None, query.answer)
+    action = query.data.split(":", 1)[1]
+    if action == 'sort':
+        state.update(sort='title' if state['sort'] == 'new' else 'new', page=0)
+        text, markup = await render_links_page(state)
+    elif action == 'prev':
+        text, markup = await render_links_page(state, state['first'], backward=True)
+    else:
+        text, markup = await render_links_page(state, state['last'])
+    if text:
+        await tg_send(PRIORITY_ADMIN, update.effective_chat.id, query.edit_message_text, text, reply_markup=markup, parse_mode='Markdown')
 
 async def button_callback_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     query = update.callback_query
-    await query.answer()
-    bot_info = await context.bot.get_me()
-    await query.message.reply_text(f"🔗 লিঙ্ক: `https://t.me/{bot_info.username}?start={query.data}`", parse_mode='Markdown')
+    await tg_send(PRIORITY_INTERACTIVE, None, query.answer)
+    await reply(update, f"🔗 লিঙ্ক: `{bot_link('start=' + query.data)}`", parse_mode='Markdown')
 
 # --- চ্যানেল পোস্ট অটো-বাটন হ্যান্ডলার ---
+@timed_handler
 async def channel_post_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     post = update.channel_post
     if post:
-        btn_text = get_setting("channel_btn_name", "Open Mini App 🔐")
-        btn_url_config = get_setting("channel_btn_url", "bot")
+        btn_text = await get_setting_async("channel_btn_name", "Open Mini App 🔐")
+        btn_url_config = await get_setting_async("channel_btn_url", "bot")
         if btn_url_config == "bot":
-            bot_info = await context.bot.get_me()
-            final_url = f"https://t.me/{bot_info.username}?startapp"
+            final_url = bot_link("startapp")
         else:
             final_url = btn_url_config
         button = InlineKeyboardButton(text=btn_text, url=final_url)
         keyboard = InlineKeyboardMarkup([[button]])
         try:
-            await context.bot.edit_message_reply_markup(chat_id=post.chat_id, message_id=post.message_id, reply_markup=keyboard)
+            await tg_send(PRIORITY_ADMIN, post.chat_id, context.bot.edit_message_reply_markup, chat_id=post.chat_id, message_id=post.message_id, reply_markup=keyboard)
         except Exception as e: logger.error(f"Channel Edit Error: {e}")
 
 # --- লিঙ্ক জেনারেটর ---
@@ -363,81 +2424,122 @@ async def add_to_media_list(update: Update, context: ContextTypes.DEFAULT_TYPE)
     elif msg.photo: f_id, f_type = msg.photo[-1].file_id, 'photo'
     elif msg.text and not msg.text.startswith('/'): f_id, f_type = msg.text, 'text'
     if f_id:
-        context.user_data['multi_files'].append({'id': f_id, 'type': f_type})
+        context.user_data.setdefault('multi_files', []).append({'id': f_id, 'type': f_type})
         keyboard = InlineKeyboardMarkup([[InlineKeyboardButton("Done ✅", callback_data="done_media")]])
-        await msg.reply_text(f"📦 কন্টেন্ট `{len(context.user_data['multi_files'])}` যোগ হয়েছে।", reply_markup=keyboard)
+        await reply(update, f"📦 কন্টেন্ট `{len(context.user_data['multi_files'])}` যোগ হয়েছে।", reply_markup=keyboard)
         return GET_MEDIA
     return GET_MEDIA
 
 async def media_done_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query = update.callback_query
-    await query.answer()
-    await query.message.reply_text("✍️ শিরোনাম (Title) দিন।")
+    await tg_send(PRIORITY_INTERACTIVE, None, query.answer)
+    await reply(update, "✍️ শিরোনাম (Title) দিন।")
     return GET_TITLE
 
 async def get_title(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     context.user_data['tmp_title'] = update.message.text.strip()
-    await update.message.reply_text("🔑 ইউনিক কোড দিন (স্পেস ছাড়া)।")
+    await reply(update, "🔑 ইউনিক কোড দিন (স্পেস ছাড়া)।")
     return GET_CUSTOM_CODE
 
 async def get_custom_code(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     code = update.message.text.strip()
-    conn = get_db_connection()
-    if not conn: return ConversationHandler.END
-    try:
-        with conn.cursor() as cur:
-            files = context.user_data.get('multi_files')
-            t = context.user_data.get('tmp_title')
-            f_ids = "|".join([f['id'] for f in files])
-            f_types = "|".join([f['type'] for f in files])
-            cur.execute("INSERT INTO files (custom_code, title, file_type, file_id) VALUES (%s, %s, %s, %s)", (code, t, f_types, f_ids))
-            conn.commit()
-            bot_info = await context.bot.get_me()
-            await update.message.reply_text(f"✅ সফল! লিঙ্ক: `https://t.me/{bot_info.username}?start={code}`")
-    finally: conn.close()
+    files = context.user_data.get('multi_files')
+    t = context.user_data.get('tmp_title')
+    if not await run_db(insert_file_bundle, code, t, files): return ConversationHandler.END
+    await reply(update, f"✅ সফল! লিঙ্ক: `{bot_link('start=' + code)}`")
     return ConversationHandler.END
 
 async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    await update.message.reply_text("❌ বাতিল।")
+    await reply(update, "❌ বাতিল।")
     return ConversationHandler.END
 
-# --- Flask Server ---
-app = Flask('')
-@app.route('/')
-def home(): return "Bot is Online"
-@app.route('/webapp-open/<int:user_id>')
-def webapp_open(user_id):
+# --- HTTP সার্ভার (aiohttp, বটের একই ইভেন্ট লুপে) ---
+# BOT_MODE=polling হলে getUpdates, BOT_MODE=webhook হলে টেলিগ্রাম WEBHOOK_URL + WEBHOOK_PATH এ আপডেট পাঠায়
+# (ওয়েবহুক মোডে WEBHOOK_URL ও WEBHOOK_SECRET বাধ্যতামূলক; টেলিগ্রাম সিক্রেটটি হেডারে পাঠায়)
+PORT = int(os.environ.get("PORT", 8080))
+BOT_MODE = os.getenv("BOT_MODE", "polling").lower()
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+HTTP_SHUTDOWN_TIMEOUT = float(os.getenv("HTTP_SHUTDOWN_TIMEOUT", 10))
+BOT_APP = web.AppKey("bot_app", Application)
+
+async def home(request):
+    return web.Response(text="Bot is Online")
+
+async def db_health(request):
+    if not DATABASE_URL: return web.json_response({"error": "DATABASE_URL missing"}, status=503)
+    return web.json_response(get_db_pool().stats())
+
+@timed_handler
+async def webapp_open(request):
+    user_id = int(request.match_info['user_id'])
+    # রুটটি খোলা; bigint এর বাইরের আইডি ফ্লাশে পুরো ব্যাচ ব্যর্থ করাত
+    if not 0 < user_id <= BIGINT_MAX: return web.json_response({"error": "invalid user_id"}, status=400)
     track_app_open(user_id)
-    return {"status": "success"}
+    return web.json_response({"status": "success"})
 
-def run_flask():
-    port = int(os.environ.get("PORT", 8080))
-    app.run(host='0.0.0.0', port=port)
+async def metrics(request):
+    return web.Response(body=generate_latest(), headers={'Content-Type': CONTENT_TYPE_LATEST})
 
-def main():
-    threading.Thread(target=run_flask).start()
-    application = Application.builder().token(BOT_TOKEN).post_init(post_init).build()
+async def telegram_webhook(request):
+    token = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+    if not hmac.compare_digest(token.encode(), WEBHOOK_SECRET.encode()):
+        return web.Response(status=403)
+    application = request.app[BOT_APP]
+    try:
+        update = Update.de_json(await request.json(), application.bot)
+    except Exception as e:
+        logger.warning(f"Webhook Payload Error: {e}")
+        return web.Response(status=400)
+    await application.update_queue.put(update)
+    return web.Response()
+
+def build_web_app(application):
+    QUEUE_DEPTH.labels('updates').set_function(application.update_queue.qsize)
+    web_app = web.Application()
+    web_app[BOT_APP] = application
+    web_app.router.add_get('/', home)
+    web_app.router.add_get('/health/db', db_health)
+    web_app.router.add_get('/metrics', metrics)
+    web_app.router.add_get(r'/webapp-open/{user_id:\d+}', webapp_open)
+    # পোলিং মোডে এই রুট থাকলে যে কেউ নকল আপডেট (যেমন অ্যাডমিনের নামে) পাঠাতে পারত
+    if BOT_MODE == 'webhook': web_app.router.add_post(WEBHOOK_PATH, telegram_webhook)
+    return web_app
+
+def build_application():
+    # concurrent_updates: এক ইউজারের ধীর কুয়েরি অন্যদের আপডেট আটকে রাখবে না
+    application = (
+        Application.builder().token(BOT_TOKEN).base_url(TELEGRAM_API_URL).base_file_url(TELEGRAM_FILE_URL)
+        .concurrent_updates(CONCURRENT_UPDATES).persistence(bot_persistence).build()
+    )
     
     # কমান্ড এবং কনভারসেশন হ্যান্ডলার
+    application.add_handler(TypeHandler(Update, sync_admin_state), group=-1)
+    application.add_handler(TypeHandler(Update, persist_admin_state), group=1)
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CommandHandler("alllink", all_links))
     application.add_handler(CommandHandler("statics", statics_command))
+    application.add_handler(CommandHandler("segment", segment_command))
     application.add_handler(CommandHandler("cancel", cancel))
     
     application.add_handler(ConversationHandler(
         entry_points=[CommandHandler("setbtn", set_btn_start)],
         states={SET_BTN_NAME: [MessageHandler(filters.TEXT & ~filters.COMMAND, save_btn_name)]},
-        fallbacks=[CommandHandler("cancel", cancel)]
+        fallbacks=[CommandHandler("cancel", cancel)],
+        name="setbtn", persistent=True,
     ))
     application.add_handler(ConversationHandler(
         entry_points=[CommandHandler("seturl", set_url_start)],
         states={SET_BTN_URL: [MessageHandler(filters.TEXT & ~filters.COMMAND, save_btn_url)]},
-        fallbacks=[CommandHandler("cancel", cancel)]
+        fallbacks=[CommandHandler("cancel", cancel)],
+        name="seturl", persistent=True,
     ))
     application.add_handler(ConversationHandler(
         entry_points=[CommandHandler("broadcast", broadcast_command)],
         states={GET_BROADCAST_MSG: [MessageHandler(filters.ALL & ~filters.COMMAND, send_broadcast)]},
         fallbacks=[CommandHandler("cancel", cancel)],
+        name="broadcast", persistent=True,
     ))
     application.add_handler(ConversationHandler(
         entry_points=[MessageHandler((filters.VIDEO | filters.Document.ALL | filters.AUDIO | filters.PHOTO | filters.TEXT) & ~filters.COMMAND & filters.ChatType.PRIVATE, handle_admin_input)],
@@ -450,12 +2552,87 @@ def main():
             GET_CUSTOM_CODE: [MessageHandler(filters.TEXT & ~filters.COMMAND, get_custom_code)]
         },
         fallbacks=[CommandHandler("cancel", cancel)],
+        name="new_link", persistent=True,
     ))
     
     application.add_handler(MessageHandler(filters.ChatType.CHANNEL, channel_post_handler))
+    application.add_handler(CallbackQueryHandler(links_page_callback, pattern="^links:"))
     application.add_handler(CallbackQueryHandler(button_callback_handler))
-    
-    application.run_polling()
+    return application
+
+def webhook_config_error():
+    """ওয়েবহুক মোডের কনফিগারেশন অসম্পূর্ণ হলে কারণ ফেরত দেয়"""
+    if BOT_MODE != 'webhook': return None
+    if not WEBHOOK_URL: return "WEBHOOK_URL variable missing!"
+    if not WEBHOOK_SECRET: return "WEBHOOK_SECRET variable missing!"
+    return None
+
+async def run_bot():
+    """বট ও HTTP সার্ভার একই লুপে চালায়; SIGINT/SIGTERM এ চলমান রিকোয়েস্ট ও আপডেট শেষ করে বন্ধ হয়"""
+    application = build_application()
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM): loop.add_signal_handler(sig, stop_event.set)
+
+    runner = web.AppRunner(build_web_app(application), shutdown_timeout=HTTP_SHUTDOWN_TIMEOUT)
+    # initialize() এ persistence থেকে স্টেট লোড হয়; স্কিমা main() এ আগেই হালনাগাদ হয়েছে
+    await application.initialize()
+    await post_init(application)
+    await application.start()
+    await runner.setup()
+    await web.TCPSite(runner, '0.0.0.0', PORT).start()
+    if BOT_MODE == 'webhook':
+        await application.bot.set_webhook(url=WEBHOOK_URL.rstrip('/') + WEBHOOK_PATH, secret_token=WEBHOOK_SECRET)
+        logger.info(f"Webhook mode: listening on port {PORT}{WEBHOOK_PATH}")
+    else:
+        await application.bot.delete_webhook()
+        await application.updater.start_polling()
+        logger.info(f"Polling mode: HTTP server on port {PORT}")
+
+    try:
+        await stop_event.wait()
+    finally:
+        if application.updater.running: await application.updater.stop()
+        # নতুন কানেকশন বন্ধ, চলমান রিকোয়েস্ট (ওয়েবহুক সহ) HTTP_SHUTDOWN_TIMEOUT পর্যন্ত শেষ হতে দেয়
+        await runner.cleanup()
+        # লাইনে থাকা আপডেটগুলো প্রসেস করে থামে
+        await application.stop()
+        await post_stop(application)
+        await application.shutdown()
+
+def main():
+    config_error = webhook_config_error()
+    if config_error:
+        logger.error(config_error)
+        return
+    # নতুন ডেটাবেসে টেবিল না থাকলে ওয়ার্মআপ কুয়েরি ও বাফার ফ্লাশ ব্যর্থ হত, তাই আগে মাইগ্রেশন
+    migrate_db()
+    load_recent_app_opens()
+    hit_buffer.start()
+    user_buffer.start()
+    bot_persistence.buffer.start()
+    try:
+        asyncio.run(run_bot())
+    finally:
+        # বন্ধ হওয়ার আগে জমে থাকা হিট ও ইউজার ফ্লাশ করা
+        hit_buffer.stop()
+        user_buffer.stop()
+        bot_persistence.buffer.stop()
+        db_executor.shutdown(wait=True)
+        if db_pool: db_pool.closeall()
+
+def run_bundle_cli(command, path):
+    if command == 'export-bundles':
+        with open(path, 'w', encoding='utf-8') as out:
+            logger.info(f"Exported {export_bundles(out)} bundles to {path}.")
+    else:
+        with open(path, encoding='utf-8') as lines:
+            imported, skipped = import_bundles(lines)
+        logger.info(f"Imported {imported} bundles from {path} ({skipped} existing, duplicate or invalid skipped).")
+    if db_pool: db_pool.closeall()
 
 if __name__ == '__main__':
-    main()
+    if len(sys.argv) == 3 and sys.argv[1] in ('export-bundles', 'import-bundles'):
+        run_bundle_cli(sys.argv[1], sys.argv[2])
+    else:
+        main()